@@ -10,7 +10,8 @@ setup(
     url = 'https://github.com/jlaine/django-timegraph',
     author = u'Jeremy Lainé',
     author_email = 'jeremy.laine@m4x.org',
-    packages = ['timegraph', 'timegraph.migrations', 'timegraph.templatetags'],
+    packages = ['timegraph', 'timegraph.management', 'timegraph.management.commands',
+                'timegraph.migrations', 'timegraph.templatetags'],
     package_data = {
         'timegraph': [
             'locale/fr/LC_MESSAGES/*.mo',
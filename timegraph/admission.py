@@ -0,0 +1,285 @@
+# -*- coding: utf-8 -*-
+#
+# django-timegraph - monitoring graphs for django
+# Copyright (c) 2011-2012, Wifirst
+# Copyright (c) 2013, Jeremy Lainé
+# All rights reserved.
+#
+# See AUTHORS file for a full list of contributors.
+#
+# Redistribution and use in source and binary forms, with or without modification,
+# are permitted provided that the following conditions are met:
+#
+#     1. Redistributions of source code must retain the above copyright notice,
+#        this list of conditions and the following disclaimer.
+#
+#     2. Redistributions in binary form must reproduce the above copyright
+#        notice, this list of conditions and the following disclaimer in the
+#        documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR
+# ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+# ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+import errno
+import fcntl
+import os
+import tempfile
+import time
+import uuid
+from contextlib import contextmanager
+from functools import wraps
+
+from django.conf import settings
+from django.http import HttpResponse
+
+from timegraph.forms import GraphForm
+from timegraph.locking import lock_file
+from timegraph.series import resolve_time
+
+
+class Overloaded(Exception):
+    """
+    Raised when a request is not admitted, with the number of seconds after
+    which the client may retry.
+    """
+    def __init__(self, retry_after):
+        super(Overloaded, self).__init__('too many expensive requests')
+        self.retry_after = retry_after
+
+
+def estimate_cost(defs, start, end, width, height, zoom=1.0):
+    """
+    Estimates the cost of rendering a graph with the given number of DEFs,
+    time range and image size.
+
+    A single DEF over a week, rendered in a 300x200 image, costs about 2.
+    """
+    now = time.time()
+    span = max(resolve_time(end, now) - resolve_time(start, now), 0)
+    return defs * (1 + span / 604800.0) + width * height * zoom * zoom / 100000.0
+
+
+class AdmissionController(object):
+    """
+    Limits the number of expensive requests rendered at once by all the
+    processes sharing the `directory`.
+
+    Requests costing at most `cheap_cost` always run right away. Expensive
+    requests run while fewer than `max_running` of them do, and otherwise
+    wait in a queue of at most `max_queued` requests, where the cheapest run
+    first. A client may have at most `per_client` expensive requests running
+    or waiting. Requests which cannot be queued, or which wait more than
+    `timeout` seconds, are refused.
+
+    A running request holds a lock on one of `max_running` slot files, and
+    a waiting one on its file in the queue directory, so that the requests
+    of processes which died are ignored. Waiting requests check for a free
+    slot every `poll` seconds.
+
+    Admission control is disabled if `max_running` is 0.
+    """
+    def __init__(self, max_running=0, max_queued=32, per_client=4, cheap_cost=20, timeout=30,
+                 directory=None, poll=0.05):
+        self.max_running = max_running
+        self.max_queued = max_queued
+        self.per_client = per_client
+        self.cheap_cost = cheap_cost
+        self.timeout = timeout
+        self.directory = directory or os.path.join(tempfile.gettempdir(), 'timegraph-render')
+        self.poll = poll
+
+    @contextmanager
+    def admit(self, client, cost):
+        """
+        Holds a slot for an expensive request while the block executes,
+        waiting for one if needed. Raises Overloaded if the request is
+        refused.
+        """
+        if not self.max_running or cost <= self.cheap_cost:
+            yield
+            return
+
+        slot = self._enter(client, cost)
+        try:
+            yield
+        finally:
+            os.close(slot)
+
+    def state(self):
+        """
+        Returns the clients of the running requests, and those of the
+        waiting requests, cheapest first.
+        """
+        with self._locked():
+            running, slot = self._slots()
+            if slot is not None:
+                os.close(slot)
+            return running, [item[1] for item in self._queue()]
+
+    def _enter(self, client, cost):
+        """
+        Returns the locked descriptor of a free slot, queueing the request
+        until there is one.
+        """
+        deadline = time.time() + self.timeout
+        name = None
+        entry = None
+        try:
+            while True:
+                with self._locked():
+                    running, slot = self._slots()
+                    queue = self._queue()
+                    if name is None:
+                        waiting = [item[1] for item in queue]
+                        if (running + waiting).count(client) >= self.per_client:
+                            raise Overloaded(self.timeout)
+                    if slot is not None and (queue[0][0] == name if queue else name is None):
+                        os.ftruncate(slot, 0)
+                        os.write(slot, client.encode('utf-8'))
+                        return slot
+                    if slot is not None:
+                        os.close(slot)
+                    if name is None:
+                        if len(queue) >= self.max_queued:
+                            raise Overloaded(self.timeout)
+                        name = '%016.4f-%017.6f-%s' % (cost, time.time(), uuid.uuid4().hex)
+                        entry = self._open(os.path.join(self.directory, 'queue', name), client)
+                if time.time() >= deadline:
+                    raise Overloaded(self.timeout)
+                time.sleep(self.poll)
+        finally:
+            if entry is not None:
+                os.remove(os.path.join(self.directory, 'queue', name))
+                os.close(entry)
+
+    @contextmanager
+    def _locked(self):
+        try:
+            os.makedirs(os.path.join(self.directory, 'queue'))
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        with lock_file(os.path.join(self.directory, 'lock')):
+            yield
+
+    def _open(self, path, client):
+        """
+        Creates a file holding the given client and returns its locked
+        descriptor.
+        """
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        os.write(fd, client.encode('utf-8'))
+        return fd
+
+    def _read_locked(self, path):
+        """
+        Returns the client held by the given file if another request holds
+        its lock, or else the file's descriptor, locked.
+        """
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except (IOError, OSError) as e:
+            if e.errno not in (errno.EAGAIN, errno.EACCES):
+                os.close(fd)
+                raise
+            try:
+                return os.read(fd, 1024).decode('utf-8')
+            finally:
+                os.close(fd)
+        return fd
+
+    def _slots(self):
+        """
+        Returns the clients of the running requests, and the locked
+        descriptor of a free slot, or None.
+        """
+        running = []
+        free = None
+        for i in range(self.max_running):
+            result = self._read_locked(os.path.join(self.directory, 'slot-%d' % i))
+            if not isinstance(result, int):
+                running.append(result)
+            elif free is None:
+                free = result
+            else:
+                os.close(result)
+        return running, free
+
+    def _queue(self):
+        """
+        Returns the (name, client) entries of the waiting requests, cheapest
+        first, removing those of requests which died.
+        """
+        queue = []
+        directory = os.path.join(self.directory, 'queue')
+        for name in sorted(os.listdir(directory)):
+            path = os.path.join(directory, name)
+            result = self._read_locked(path)
+            if isinstance(result, int):
+                os.remove(path)
+                os.close(result)
+            else:
+                queue.append((name, result))
+        return queue
+
+
+admission_controller = AdmissionController(
+    max_running=getattr(settings, 'TIMEGRAPH_RENDER_MAX_RUNNING', 0),
+    max_queued=getattr(settings, 'TIMEGRAPH_RENDER_MAX_QUEUED', 32),
+    per_client=getattr(settings, 'TIMEGRAPH_RENDER_PER_CLIENT', 4),
+    cheap_cost=getattr(settings, 'TIMEGRAPH_RENDER_CHEAP_COST', 20),
+    timeout=getattr(settings, 'TIMEGRAPH_RENDER_TIMEOUT', 30),
+    directory=getattr(settings, 'TIMEGRAPH_RENDER_LOCK_DIR', None))
+
+
+def client_key(request):
+    """
+    Returns the key identifying the client of the given request.
+    """
+    user = getattr(request, 'user', None)
+    if user is not None and user.pk is not None:
+        return 'user:%s' % user.pk
+    return 'addr:%s' % request.META.get('REMOTE_ADDR')
+
+
+def admission_control(count_defs):
+    """
+    Decorates a graph view to go through admission control.
+
+    `count_defs` is called with the view's arguments, after the request,
+    and returns the number of DEFs the graph may hold along with the
+    arguments to call the view with, so that it can evaluate iterables
+    the view would otherwise consume.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            controller = admission_controller
+            form = GraphForm(request.GET)
+            if not controller.max_running or not form.is_valid():
+                return view(request, *args, **kwargs)
+
+            data = form.cleaned_data
+            defs, args = count_defs(*args, **kwargs)
+            cost = estimate_cost(defs, data['start'], data['end'], data['width'], data['height'], data['zoom'])
+            try:
+                with controller.admit(client_key(request), cost):
+                    return view(request, *args)
+            except Overloaded as e:
+                response = HttpResponse('Too many expensive requests, please retry later.\n',
+                                        content_type='text/plain', status=503)
+                response['Retry-After'] = str(int(e.retry_after))
+                return response
+        return wrapper
+    return decorator
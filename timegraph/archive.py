@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+#
+# django-timegraph - monitoring graphs for django
+# Copyright (c) 2011-2012, Wifirst
+# Copyright (c) 2013, Jeremy Lainé
+# All rights reserved.
+#
+# See AUTHORS file for a full list of contributors.
+#
+# Redistribution and use in source and binary forms, with or without modification,
+# are permitted provided that the following conditions are met:
+#
+#     1. Redistributions of source code must retain the above copyright notice, 
+#        this list of conditions and the following disclaimer.
+#     
+#     2. Redistributions in binary form must reproduce the above copyright 
+#        notice, this list of conditions and the following disclaimer in the
+#        documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR
+# ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+# ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import calendar
+import errno
+import os
+import time
+import uuid
+import zipfile
+
+import numpy
+
+from timegraph.export import _write_array
+from timegraph.models import Metric
+from timegraph.series import align_series, archive_paths, fetch_rrd
+
+try:
+    from os import scandir
+except ImportError:
+    from scandir import scandir
+
+
+def archive_month(year, month, resolution=7200):
+    """
+    Copies the data of every RRD file for the given month to the archives.
+
+    The archives of an object type and month are made of compressed
+    segments, and each run adds a segment holding the series not archived
+    yet: for every RRD file, 'time', 'AVERAGE' and 'MAX' arrays at the given
+    resolution, or the closest one the file still holds. Segments are
+    written under a temporary name and renamed once complete, so they are
+    never modified after being published.
+
+    Returns the number of archived series.
+    """
+    start = calendar.timegm((year, month, 1, 0, 0, 0))
+    end = calendar.timegm((year + month // 12, month % 12 + 1, 1, 0, 0, 0))
+    count = 0
+    type_paths = {}
+    for root in Metric.rrd_roots():
+        if os.path.isdir(root):
+            for type_entry in scandir(root):
+                if type_entry.is_dir():
+                    type_paths.setdefault(type_entry.name, []).append(type_entry.path)
+
+    for obj_type, paths in sorted(type_paths.items()):
+        names = set()
+        for path in archive_paths(obj_type, year, month):
+            try:
+                archive = zipfile.ZipFile(path)
+            except zipfile.BadZipfile:
+                continue
+            names.update(archive.namelist())
+            archive.close()
+
+        directory = os.path.join(Metric.archive_root, obj_type)
+        try:
+            os.makedirs(directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        path = os.path.join(directory, '%04d-%02d.%d.%s.npz' % (year, month, time.time(), uuid.uuid4().hex[:8]))
+        tmp_path = path + '.tmp'
+        archived = 0
+        try:
+            with open(tmp_path, 'wb') as fp:
+                archive = zipfile.ZipFile(fp, 'w', zipfile.ZIP_DEFLATED, allowZip64=True)
+                try:
+                    for obj_entry in _object_dirs(paths):
+                        for entry in scandir(obj_entry.path):
+                            if not entry.name.endswith('.rrd'):
+                                continue
+                            prefix = '%s/%s/' % (obj_entry.name, entry.name[:-4])
+                            if prefix + 'time.npy' in names:
+                                continue
+                            if _archive_file(archive, prefix, entry.path, start, end, resolution):
+                                names.add(prefix + 'time.npy')
+                                archived += 1
+                finally:
+                    archive.close()
+                fp.flush()
+                os.fsync(fp.fileno())
+            if archived:
+                os.rename(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        count += archived
+    return count
+
+
+def _object_dirs(paths):
+    """
+    Yields the object directories found in the given type directories.
+    """
+    for path in paths:
+        for obj_entry in scandir(path):
+            if obj_entry.is_dir():
+                yield obj_entry
+
+
+def _archive_file(archive, prefix, filepath, start, end, resolution):
+    """
+    Writes the data of a single RRD file to the archive, unless it holds
+    no data for the time range.
+    """
+    timestamps, average = fetch_rrd(filepath, 'AVERAGE', start, end, resolution)
+    mask = (timestamps > start) & (timestamps <= end)
+    timestamps, average = timestamps[mask], average[mask]
+    if numpy.isnan(average).all():
+        return False
+
+    max_timestamps, maximum = fetch_rrd(filepath, 'MAX', start, end, resolution)
+    if not numpy.array_equal(max_timestamps, timestamps):
+        maximum = align_series(max_timestamps, maximum, timestamps)
+
+    # the time array is written last, as it marks the series as complete
+    _write_array(archive, prefix + 'AVERAGE', average)
+    _write_array(archive, prefix + 'MAX', maximum)
+    _write_array(archive, prefix + 'time', timestamps)
+    return True
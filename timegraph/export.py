@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+#
+# django-timegraph - monitoring graphs for django
+# Copyright (c) 2011-2012, Wifirst
+# Copyright (c) 2013, Jeremy Lainé
+# All rights reserved.
+#
+# See AUTHORS file for a full list of contributors.
+#
+# Redistribution and use in source and binary forms, with or without modification,
+# are permitted provided that the following conditions are met:
+#
+#     1. Redistributions of source code must retain the above copyright notice, 
+#        this list of conditions and the following disclaimer.
+#     
+#     2. Redistributions in binary form must reproduce the above copyright 
+#        notice, this list of conditions and the following disclaimer in the
+#        documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR
+# ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+# ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import io
+import itertools
+import multiprocessing
+import os
+import zipfile
+
+import numpy
+from django.utils.encoding import force_unicode
+
+from timegraph.series import align_series
+from timegraph.storage import get_backend
+
+
+def _fetch(args):
+    """
+    Fetches a single RRD file, returning None if it does not exist.
+    """
+    filepath, backend_name, cf, start, end, resolution = args
+    if not os.path.exists(filepath):
+        return None
+    return get_backend(backend_name).fetch(filepath, cf, start, end, resolution)
+
+
+def _chunks(iterable, size):
+    """
+    Splits the given iterable into lists of at most `size` items.
+    """
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _write_array(archive, name, array):
+    """
+    Writes an array to the given zip archive in .npy format.
+    """
+    buf = io.BytesIO()
+    numpy.lib.format.write_array(buf, numpy.asanyarray(array))
+    archive.writestr(name + '.npy', buf.getvalue())
+
+
+def export_series(fileobj, metrics, object_list, start=-86400, end=-1, cf='AVERAGE',
+                  resolution=None, chunk_size=1000, processes=None, compress=False):
+    """
+    Exports the series of the given metrics for the given objects to a
+    NumPy .npz archive.
+
+    The archive holds a 'metrics' array with the metric primary keys, a
+    'timestamps' array, and for each chunk of objects a 'pks_NNNNN' array
+    with the object primary keys and a 'values_NNNNN' array of shape
+    (objects, metrics, timestamps). Missing series are filled with NaN.
+
+    RRD files are read by a pool of `processes` workers, and only one chunk
+    of objects is held in memory at a time.
+
+    Returns the number of exported objects.
+    """
+    metrics = list(metrics)
+    compression = compress and zipfile.ZIP_DEFLATED or zipfile.ZIP_STORED
+    archive = zipfile.ZipFile(fileobj, 'w', compression, allowZip64=True)
+    _write_array(archive, 'metrics', [metric.pk for metric in metrics])
+
+    def write_chunk(index, pks, results):
+        values = numpy.empty((len(pks), len(metrics), len(grid)), dtype=numpy.float64)
+        values.fill(numpy.nan)
+        for i, result in enumerate(results):
+            if result is None:
+                continue
+            timestamps, series = result
+            if not numpy.array_equal(timestamps, grid):
+                series = align_series(timestamps, series, grid)
+            values[i // len(metrics), i % len(metrics)] = series
+        _write_array(archive, 'pks_%05d' % index, pks)
+        _write_array(archive, 'values_%05d' % index, values)
+
+    grid = None
+    count = 0
+    pending = []
+    pool = multiprocessing.Pool(processes)
+    try:
+        for index, chunk in enumerate(_chunks(object_list, chunk_size)):
+            pks = [force_unicode(obj.pk) for obj in chunk]
+            results = pool.map(_fetch, [
+                (metric.rrd_path(obj), metric.backend_name, cf, start, end, resolution)
+                for obj in chunk for metric in metrics])
+            count += len(chunk)
+
+            # the time grid is that of the first series found
+            if grid is None:
+                for result in results:
+                    if result is not None:
+                        grid = result[0]
+                        break
+                else:
+                    pending.append((index, pks))
+                    continue
+                for pending_index, pending_pks in pending:
+                    write_chunk(pending_index, pending_pks, [])
+                pending = []
+            write_chunk(index, pks, results)
+    finally:
+        pool.close()
+        pool.join()
+
+    if grid is None:
+        grid = numpy.array([], dtype=numpy.int64)
+        for pending_index, pending_pks in pending:
+            write_chunk(pending_index, pending_pks, [])
+    _write_array(archive, 'timestamps', grid)
+    archive.close()
+    return count
@@ -32,6 +32,19 @@
 from django import forms
 
 class GraphForm(forms.Form):
+    FORMAT_CHOICES = (
+        ('png', 'PNG'),
+        ('svg', 'SVG'),
+        ('svgz', 'compressed SVG'),
+    )
+
+    # rrdtool image format and HTTP content type of each format
+    FORMATS = {
+        'png': ('PNG', 'image/png'),
+        'svg': ('SVG', 'image/svg+xml'),
+        'svgz': ('SVG', 'image/svg+xml'),
+    }
+
     start = forms.IntegerField(required=False, initial=-86400)
     end = forms.IntegerField(required=False, initial=-1)
     only_graph = forms.BooleanField(required=False)
@@ -39,6 +52,9 @@ class GraphForm(forms.Form):
     height = forms.IntegerField(required=False, initial=200)
     title = forms.CharField(required=False)
     watermark = forms.CharField(required=False)
+    format = forms.ChoiceField(required=False, initial='png', choices=FORMAT_CHOICES)
+    zoom = forms.FloatField(required=False, initial=1.0, min_value=0.5, max_value=4.0)
+    mono = forms.BooleanField(required=False)
 
     def clean(self):
         """
@@ -48,11 +64,11 @@ class GraphForm(forms.Form):
 
         # set defaults
         for k in self.fields:
-            if (data[k] is None or data[k] == '') and (self.fields[k].initial is not None):
+            if k in data and (data[k] is None or data[k] == '') and (self.fields[k].initial is not None):
                 data[k] = self.fields[k].initial
 
         # check start / end
-        if data['start'] >= data['end']:
+        if 'start' in data and 'end' in data and data['start'] >= data['end']:
             raise forms.ValidationError('start should be less than end')
 
         return data
@@ -68,7 +84,7 @@ class GraphForm(forms.Form):
         Returns options for rrdgraph.
         """
         options = [
-            '--imgformat', 'PNG',
+            '--imgformat', self.FORMATS[self.cleaned_data['format']][0],
             '--full-size-mode',
             '--width', self.cleaned_data['width'],
             '--height', self.cleaned_data['height'],
@@ -79,5 +95,31 @@ class GraphForm(forms.Form):
         ]
         if self.cleaned_data['only_graph']:
             options += ['--only-graph']
+        if self.cleaned_data['zoom'] != 1.0:
+            options += ['--zoom', self.cleaned_data['zoom']]
+        if self.cleaned_data['mono']:
+            # without anti-aliasing, images use few colors and compress better
+            options += ['--graph-render-mode', 'mono', '--font-render-mode', 'mono']
         return options
 
+    def content_type(self):
+        """
+        Returns the HTTP content type of the image.
+        """
+        return self.FORMATS[self.cleaned_data['format']][1]
+
+class TopForm(GraphForm):
+    REDUCTION_CHOICES = (
+        ('avg', 'average'),
+        ('max', 'maximum'),
+        ('min', 'minimum'),
+        ('last', 'last'),
+        ('percentile', 'percentile'),
+    )
+
+    start = forms.IntegerField(required=False, initial=-3600)
+    count = forms.IntegerField(required=False, initial=50, min_value=1, max_value=1000)
+    reduction = forms.ChoiceField(required=False, initial='avg', choices=REDUCTION_CHOICES)
+    percentile = forms.IntegerField(required=False, initial=95, min_value=0, max_value=100)
+    bottom = forms.BooleanField(required=False)
+    graph = forms.BooleanField(required=False)
@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+#
+# django-timegraph - monitoring graphs for django
+# Copyright (c) 2011-2012, Wifirst
+# Copyright (c) 2013, Jeremy Lainé
+# All rights reserved.
+#
+# See AUTHORS file for a full list of contributors.
+#
+# Redistribution and use in source and binary forms, with or without modification,
+# are permitted provided that the following conditions are met:
+#
+#     1. Redistributions of source code must retain the above copyright notice, 
+#        this list of conditions and the following disclaimer.
+#     
+#     2. Redistributions in binary form must reproduce the above copyright 
+#        notice, this list of conditions and the following disclaimer in the
+#        documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR
+# ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+# ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import json
+import rrdtool
+import zlib
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.utils.encoding import force_unicode
+
+from timegraph.models import Metric
+
+
+# lines longer than this many bytes are refused
+max_line_length = getattr(settings, 'TIMEGRAPH_INGEST_MAX_LINE', 65536)
+
+
+def iter_lines(stream, encoding=None, chunk_size=65536, max_line=None):
+    """
+    Yields the lines of the given stream, decompressing it on the fly if
+    its encoding is 'gzip'.
+
+    At most `chunk_size` bytes are decompressed at once, and lines longer
+    than `max_line` bytes are skipped, yielding None in their place.
+    """
+    if max_line is None:
+        max_line = max_line_length
+    if encoding == 'gzip':
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    else:
+        decompressor = None
+
+    def chunks():
+        while True:
+            data = stream.read(chunk_size)
+            if not data:
+                break
+            if decompressor is None:
+                yield data
+                continue
+            while data:
+                yield decompressor.decompress(data, chunk_size)
+                data = decompressor.unconsumed_tail
+        if decompressor:
+            yield decompressor.flush()
+
+    pending = b''
+    skipping = False
+    for data in chunks():
+        lines = (pending + data).split(b'\n')
+        pending = lines.pop()
+        for line in lines:
+            if skipping or len(line) > max_line:
+                skipping = False
+                yield None
+            else:
+                yield line
+        if len(pending) > max_line:
+            # drop the line until its end
+            skipping = True
+            pending = b''
+    if skipping:
+        yield None
+    else:
+        yield pending
+
+
+def _parse(line):
+    """
+    Parses a single line into a (pk, timestamp, values) tuple.
+    """
+    item = json.loads(line.decode('utf-8'))
+    if not isinstance(item, dict) or not isinstance(item.get('values'), dict):
+        raise ValueError('expected an object with "pk" and "values"')
+
+    pk = item.get('pk')
+    if isinstance(pk, (dict, list)) or pk is None:
+        raise ValueError('invalid "pk"')
+    timestamp = item.get('time')
+    if timestamp is not None:
+        timestamp = int(timestamp)
+
+    values = {}
+    for parameter, value in item['values'].items():
+        if isinstance(value, (dict, list)) or value is None:
+            raise ValueError('invalid value for %r' % parameter)
+        values[parameter] = force_unicode(value)
+    return pk, timestamp, values
+
+
+def _store(batch, queryset, metrics, result):
+    """
+    Stores a batch of parsed lines, grouping the samples of each object
+    and metric into a single RRD update.
+    """
+    pk_field = queryset.model._meta.pk
+    pks = {}
+    for lineno, pk, timestamp, values in batch:
+        try:
+            pks[pk] = pk_field.to_python(pk)
+        except ValidationError:
+            pass
+    objects = queryset.in_bulk(list(set(pks.values())))
+
+    groups = {}
+    for lineno, pk, timestamp, values in batch:
+        obj = pk in pks and objects.get(pks[pk]) or None
+        if obj is None:
+            result['errors'].append({'line': lineno, 'error': 'unknown object %s' % pk})
+            continue
+        for parameter, value in values.items():
+            metric = metrics.get(parameter)
+            if metric is None:
+                result['errors'].append({'line': lineno, 'error': 'unknown metric %s' % parameter})
+                continue
+            group = groups.setdefault((obj.pk, metric.pk), (obj, metric, {}))
+            group[2][timestamp] = (lineno, value)
+
+    values = {}
+    for obj, metric, samples in groups.values():
+        # samples without a timestamp are stored at the current time
+        times = sorted(samples, key=lambda x: (x is None, x))
+        if metric.rrd_enabled:
+            try:
+                metric.update_rrd(obj, [(x is None and 'N' or x, samples[x][1]) for x in times])
+            except (rrdtool.error, ValueError) as e:
+                for x in times:
+                    result['errors'].append({'line': samples[x][0], 'error': str(e)})
+                continue
+        values[metric._cache_key(obj)] = samples[times[-1]][1]
+        result['samples'] += len(times)
+    cache.set_many(values, Metric.cache_timeout)
+
+
+def ingest(stream, queryset, encoding=None, batch_size=1000):
+    """
+    Stores the metric values read from a stream of JSON lines, each of
+    which looks like:
+
+        {"pk": "<object pk>", "time": <UNIX timestamp>, "values": {"<parameter>": <value>}}
+
+    The "time" is optional and defaults to the current time. Objects are
+    looked up in the given queryset, and metrics by their parameter.
+    Lines are read incrementally and stored in batches of `batch_size`.
+
+    Returns a dictionary with the number of stored 'samples' and the list
+    of per-line 'errors'.
+    """
+    metrics = dict((metric.parameter, metric) for metric in Metric.objects.all())
+    result = {'samples': 0, 'errors': []}
+
+    batch = []
+    for lineno, line in enumerate(iter_lines(stream, encoding), 1):
+        if line is None:
+            result['errors'].append({'line': lineno, 'error': 'line too long'})
+            continue
+        if not line.strip():
+            continue
+        try:
+            batch.append((lineno,) + _parse(line))
+        except (TypeError, ValueError) as e:
+            result['errors'].append({'line': lineno, 'error': str(e)})
+            continue
+        if len(batch) >= batch_size:
+            _store(batch, queryset, metrics, result)
+            batch = []
+    if batch:
+        _store(batch, queryset, metrics, result)
+
+    result['errors'].sort(key=lambda error: error['line'])
+    return result
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+#
+# django-timegraph - monitoring graphs for django
+# Copyright (c) 2011-2012, Wifirst
+# Copyright (c) 2013, Jeremy Lainé
+# All rights reserved.
+#
+# See AUTHORS file for a full list of contributors.
+#
+# Redistribution and use in source and binary forms, with or without modification,
+# are permitted provided that the following conditions are met:
+#
+#     1. Redistributions of source code must retain the above copyright notice, 
+#        this list of conditions and the following disclaimer.
+#     
+#     2. Redistributions in binary form must reproduce the above copyright 
+#        notice, this list of conditions and the following disclaimer in the
+#        documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR
+# ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+# ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from timegraph.archive import archive_month
+from timegraph.models import Metric
+
+
+class Command(BaseCommand):
+    help = 'Copies a month of data from the RRD files to the archives.'
+    option_list = BaseCommand.option_list + (
+        make_option('--month', dest='month',
+            help='Month to archive, as YYYY-MM (default: the previous month).'),
+        make_option('--resolution', dest='resolution', type='int', default=7200,
+            help='Resolution of the archived data, in seconds (default: 7200).'),
+    )
+
+    def handle(self, *args, **options):
+        if not Metric.archive_root:
+            raise CommandError('TIMEGRAPH_ARCHIVE_ROOT is not set')
+
+        if options['month']:
+            try:
+                year, month = [int(x) for x in options['month'].split('-')]
+            except ValueError:
+                raise CommandError('Invalid month %r' % options['month'])
+        else:
+            year, month = time.gmtime()[:2]
+            year, month = month == 1 and (year - 1, 12) or (year, month - 1)
+
+        count = archive_month(year, month, resolution=options['resolution'])
+        self.stdout.write('Archived %d series for %04d-%02d\n' % (count, year, month))
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+#
+# django-timegraph - monitoring graphs for django
+# Copyright (c) 2011-2012, Wifirst
+# Copyright (c) 2013, Jeremy Lainé
+# All rights reserved.
+#
+# See AUTHORS file for a full list of contributors.
+#
+# Redistribution and use in source and binary forms, with or without modification,
+# are permitted provided that the following conditions are met:
+#
+#     1. Redistributions of source code must retain the above copyright notice, 
+#        this list of conditions and the following disclaimer.
+#     
+#     2. Redistributions in binary form must reproduce the above copyright 
+#        notice, this list of conditions and the following disclaimer in the
+#        documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR
+# ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+# ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from timegraph.export import export_series
+from timegraph.management.utils import get_metrics, get_object_list
+
+
+class Command(BaseCommand):
+    args = '<app_label.model> [metric_id metric_id ...]'
+    help = 'Exports the series of metrics for all objects of a model to a NumPy .npz file.'
+    option_list = BaseCommand.option_list + (
+        make_option('-o', '--output', dest='output',
+            help='Path of the .npz file to write.'),
+        make_option('--start', dest='start', type='int', default=-86400,
+            help='Start of the time range, in seconds (default: -86400).'),
+        make_option('--end', dest='end', type='int', default=-1,
+            help='End of the time range, in seconds (default: -1).'),
+        make_option('--cf', dest='cf', default='AVERAGE', choices=['AVERAGE', 'MAX'],
+            help='Consolidation function (default: AVERAGE).'),
+        make_option('--resolution', dest='resolution', type='int',
+            help='Resolution of the series, in seconds.'),
+        make_option('--chunk-size', dest='chunk_size', type='int', default=1000,
+            help='Number of objects per chunk (default: 1000).'),
+        make_option('--processes', dest='processes', type='int',
+            help='Number of reader processes (default: number of CPUs).'),
+        make_option('--compress', dest='compress', action='store_true', default=False,
+            help='Compress the output file.'),
+    )
+
+    def handle(self, *args, **options):
+        if not args:
+            raise CommandError('You must specify a model')
+        if not options['output']:
+            raise CommandError('You must specify an output file')
+        object_list = get_object_list(args[0])
+        metrics = get_metrics(args[1:])
+
+        with open(options['output'], 'wb') as fileobj:
+            count = export_series(fileobj, metrics, object_list.iterator(),
+                start=options['start'],
+                end=options['end'],
+                cf=options['cf'],
+                resolution=options['resolution'],
+                chunk_size=options['chunk_size'],
+                processes=options['processes'],
+                compress=options['compress'])
+        self.stdout.write('Exported %d objects to %s\n' % (count, options['output']))
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+#
+# django-timegraph - monitoring graphs for django
+# Copyright (c) 2011-2012, Wifirst
+# Copyright (c) 2013, Jeremy Lainé
+# All rights reserved.
+#
+# See AUTHORS file for a full list of contributors.
+#
+# Redistribution and use in source and binary forms, with or without modification,
+# are permitted provided that the following conditions are met:
+#
+#     1. Redistributions of source code must retain the above copyright notice, 
+#        this list of conditions and the following disclaimer.
+#     
+#     2. Redistributions in binary form must reproduce the above copyright 
+#        notice, this list of conditions and the following disclaimer in the
+#        documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR
+# ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+# ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from timegraph.management.utils import get_metrics, get_object_list
+from timegraph.provision import provision
+
+
+class Command(BaseCommand):
+    args = '<app_label.model> [metric_id metric_id ...]'
+    help = 'Creates the missing RRD files of metrics for all objects of a model.'
+    option_list = BaseCommand.option_list + (
+        make_option('--after', dest='after',
+            help='Only process objects whose primary key is greater than this one.'),
+        make_option('--chunk-size', dest='chunk_size', type='int', default=1000,
+            help='Number of objects per chunk (default: 1000).'),
+        make_option('--processes', dest='processes', type='int',
+            help='Number of worker processes (default: number of CPUs).'),
+    )
+
+    def handle(self, *args, **options):
+        if not args:
+            raise CommandError('You must specify a model')
+        object_list = get_object_list(args[0])
+        metrics = get_metrics(args[1:])
+        if options['after'] is not None:
+            object_list = object_list.filter(pk__gt=options['after'])
+
+        def progress(objects, created, obj):
+            self.stdout.write('Processed %d objects, created %d files (last pk: %s)\n' % (objects, created, obj.pk))
+
+        objects, created = provision(metrics, object_list.iterator(),
+            chunk_size=options['chunk_size'],
+            processes=options['processes'],
+            progress=progress)
+        self.stdout.write('Done: processed %d objects, created %d files\n' % (objects, created))
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+#
+# django-timegraph - monitoring graphs for django
+# Copyright (c) 2011-2012, Wifirst
+# Copyright (c) 2013, Jeremy Lainé
+# All rights reserved.
+#
+# See AUTHORS file for a full list of contributors.
+#
+# Redistribution and use in source and binary forms, with or without modification,
+# are permitted provided that the following conditions are met:
+#
+#     1. Redistributions of source code must retain the above copyright notice, 
+#        this list of conditions and the following disclaimer.
+#     
+#     2. Redistributions in binary form must reproduce the above copyright 
+#        notice, this list of conditions and the following disclaimer in the
+#        documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR
+# ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+# ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from timegraph.reaper import Reaper
+
+
+class Command(BaseCommand):
+    help = 'Removes the RRD files of deleted objects and, optionally, stale RRD files.'
+    option_list = BaseCommand.option_list + (
+        make_option('--days', dest='days', type='int',
+            help='Also remove RRD files not updated for this many days.'),
+        make_option('--archive', dest='archive',
+            help='Move removed files to this directory instead of deleting them.'),
+        make_option('--cursor', dest='cursor',
+            help='File used to save the progress of the walk and resume it.'),
+        make_option('--batch-size', dest='batch_size', type='int', default=500,
+            help='Number of objects checked per database query (default: 500).'),
+        make_option('--workers', dest='workers', type='int', default=4,
+            help='Number of worker threads (default: 4).'),
+        make_option('--rate', dest='rate', type='float',
+            help='Maximum number of removals per second.'),
+        make_option('--dry-run', dest='dry_run', action='store_true', default=False,
+            help='Only report what would be removed.'),
+    )
+
+    def handle(self, *args, **options):
+        reaper = Reaper(
+            days=options['days'],
+            archive_root=options['archive'],
+            cursor_path=options['cursor'],
+            batch_size=options['batch_size'],
+            workers=options['workers'],
+            rate=options['rate'],
+            dry_run=options['dry_run'])
+        stats = reaper.run()
+        for obj_type in stats['skipped']:
+            self.stderr.write('Skipped unknown or ambiguous type %r\n' % obj_type)
+        self.stdout.write('Removed %d objects and %d stale files\n' % (stats['objects'], stats['files']))
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+#
+# django-timegraph - monitoring graphs for django
+# Copyright (c) 2011-2012, Wifirst
+# Copyright (c) 2013, Jeremy Lainé
+# All rights reserved.
+#
+# See AUTHORS file for a full list of contributors.
+#
+# Redistribution and use in source and binary forms, with or without modification,
+# are permitted provided that the following conditions are met:
+#
+#     1. Redistributions of source code must retain the above copyright notice,
+#        this list of conditions and the following disclaimer.
+#
+#     2. Redistributions in binary form must reproduce the above copyright
+#        notice, this list of conditions and the following disclaimer in the
+#        documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR
+# ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+# ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from timegraph.models import Metric
+from timegraph.rebalance import rebalance
+
+
+class Command(BaseCommand):
+    help = 'Moves RRD files to the root they are placed on, after TIMEGRAPH_RRD_ROOT changed.'
+    option_list = BaseCommand.option_list + (
+        make_option('--dry-run', dest='dry_run', action='store_true', default=False,
+            help='Only report the objects which would be moved.'),
+    )
+
+    def handle(self, *args, **options):
+        if not Metric.rrd_rebalancing:
+            self.stderr.write('Warning: TIMEGRAPH_RRD_REBALANCING is not set, files which are not moved yet '
+                              'will not be found by the processes injecting values.\n')
+        verb = options['dry_run'] and 'Would move' or 'Moved'
+
+        def progress(obj_type, obj_pk):
+            self.stdout.write('%s %s/%s\n' % (verb, obj_type, obj_pk))
+
+        objects, files, conflicts = rebalance(dry_run=options['dry_run'], progress=progress)
+        self.stdout.write('Done: moved %d objects, %d files\n' % (objects, files))
+        if conflicts:
+            self.stdout.write('Set aside %d files which already existed on their new root, '
+                              'with a .conflict suffix\n' % conflicts)
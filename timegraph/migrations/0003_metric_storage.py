@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('timegraph', '0002_auto_20150622_0644'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='metric',
+            name='storage',
+            field=models.CharField(help_text='Storage backend of the series, defaults to TIMEGRAPH_STORAGE.', max_length=16, verbose_name='storage', blank=True),
+            preserve_default=True,
+        ),
+    ]
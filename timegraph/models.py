@@ -29,15 +29,35 @@
 # SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 #
 
+import errno
 import math
 import os
 import rrdtool
+import uuid
 
 from django.conf import settings
 from django.core.cache import cache
+from django.core.exceptions import ValidationError
 from django.db import models
 from django.utils.translation import ugettext_lazy as _
 
+from timegraph.placement import get_ring
+
+
+# rrdtool's default step, in seconds
+RRD_STEP = 300
+
+RRD_ARCHIVES = (
+    'RRA:AVERAGE:0.5:1:600',
+    'RRA:AVERAGE:0.5:6:600',
+    'RRA:AVERAGE:0.5:24:600',
+    'RRA:AVERAGE:0.5:288:600',
+    'RRA:MAX:0.5:1:600',
+    'RRA:MAX:0.5:6:600',
+    'RRA:MAX:0.5:24:600',
+    'RRA:MAX:0.5:288:600',  # Up to 600d
+)
+
 
 class Graph(models.Model):
     """
@@ -85,9 +105,15 @@ class Metric(models.Model):
     rrd_enabled = models.BooleanField(default=True, verbose_name=('RRD enabled'))
     graph_color = models.CharField(blank=True, max_length=8, verbose_name=('graph color'))
     graph_order = models.IntegerField(default=0, verbose_name=('graph order'))
+    storage = models.CharField(blank=True, max_length=16, verbose_name=('storage'),
+        help_text=('Storage backend of the series, defaults to TIMEGRAPH_STORAGE.'))
 
+    default_storage = getattr(settings, 'TIMEGRAPH_STORAGE', 'rrd')
     rrd_root = getattr(settings, 'TIMEGRAPH_RRD_ROOT', '/var/lib/rrdcached/db')
+    rrd_rebalancing = getattr(settings, 'TIMEGRAPH_RRD_REBALANCING', False)
+    archive_root = getattr(settings, 'TIMEGRAPH_ARCHIVE_ROOT', None)
     cache_prefix = getattr(settings, 'TIMEGRAPH_CACHE_PREFIX', 'timegraph')
+    cache_timeout = 7 * 86400
 
     def get_polling(self, obj):
         """
@@ -99,27 +125,62 @@ class Metric(models.Model):
         """
         Stores the latest value of the metric for the given object.
         """
-        cache.set(self._cache_key(obj), value, 7 * 86400)
+        cache.set(self._cache_key(obj), value, self.cache_timeout)
         if self.rrd_enabled:
-            filepath = self.rrd_path(obj)
-            if not os.path.exists(filepath):
-                heartbeat = getattr(settings, 'TIMEGRAPH_HEARTBEAT', 300)
-                dirpath = os.path.dirname(filepath)
-                if not os.path.exists(dirpath):
-                    os.makedirs(dirpath)
-
-                rrdtool.create(filepath, 'DS:%s:GAUGE:%s:U:U' % (self.id, heartbeat),
-                               'RRA:AVERAGE:0.5:1:600',
-                               'RRA:AVERAGE:0.5:6:600',
-                               'RRA:AVERAGE:0.5:24:600',
-                               'RRA:AVERAGE:0.5:288:600',
-                               'RRA:MAX:0.5:1:600',
-                               'RRA:MAX:0.5:6:600',
-                               'RRA:MAX:0.5:24:600',
-                               'RRA:MAX:0.5:288:600')  # Up to 600d
             # As rrdupdate manpage says, "using the letter 'N', in which
             # case the update time is set to be the current time
-            rrdtool.update(filepath, str("N:%s" % value))
+            self.update_rrd(obj, [('N', value)])
+
+    def update_rrd(self, obj, samples):
+        """
+        Stores the given (timestamp, value) samples of the metric for the
+        given object with its storage backend, creating its file if needed.
+
+        The samples must be in chronological order.
+        """
+        backend = self.backend
+        while True:
+            filepath = self.rrd_path(obj)
+            if not os.path.exists(filepath):
+                # accept the first sample even if it is in the past
+                start = samples[0][0]
+                if start == 'N':
+                    start = None
+                else:
+                    start = int(start) - 1
+                backend.create(filepath, self.id, start=start)
+
+            if backend.write_batch(filepath, samples):
+                return
+            # the file was moved to another root by a rebalance, look it up again
+
+    def clean(self):
+        from timegraph.storage import STORAGE_BACKENDS
+        if self.storage and self.storage not in STORAGE_BACKENDS:
+            raise ValidationError(_('Unknown storage backend: %s') % self.storage)
+
+    @property
+    def backend(self):
+        """
+        Storage backend of the metric's series.
+        """
+        from timegraph.storage import get_backend
+        return get_backend(self.backend_name)
+
+    @property
+    def backend_name(self):
+        """
+        Name of the storage backend of the metric's series.
+        """
+        return self.storage or self.default_storage
+
+    def top(self, object_list, **kwargs):
+        """
+        Returns the objects with the highest value of the metric, see
+        :func:`timegraph.query.top_objects`.
+        """
+        from timegraph.query import top_objects
+        return top_objects(self, object_list, **kwargs)
 
     @property
     def is_summable(self):
@@ -147,7 +208,42 @@ class Metric(models.Model):
         """
         obj_type = obj.__class__.__name__.lower()
         obj_pk = str(obj.pk).replace(':', '')
-        return os.path.join(self.rrd_root, obj_type, obj_pk, '%s.rrd' % self.pk)
+        return self._rrd_path_for(obj_type, obj_pk)
+
+    def _rrd_path_for(self, obj_type, obj_pk):
+        """
+        RRD path for the given object type and primary key.
+
+        While a rebalance is in progress, a file which is not found under
+        the root the object is placed on may not have been moved there yet,
+        so the other roots are looked up.
+        """
+        filename = '%s%s' % (self.pk, self.backend.extension)
+        filepath = os.path.join(self.rrd_dir(obj_type, obj_pk), filename)
+        if self.rrd_rebalancing and not os.path.exists(filepath):
+            for root in self.rrd_roots():
+                other = os.path.join(root, obj_type, obj_pk, filename)
+                if other != filepath and os.path.exists(other):
+                    return other
+        return filepath
+
+    @classmethod
+    def rrd_roots(cls):
+        """
+        List of the directories holding RRD files.
+        """
+        if isinstance(cls.rrd_root, basestring):
+            return [cls.rrd_root]
+        return list(cls.rrd_root)
+
+    @classmethod
+    def rrd_dir(cls, obj_type, obj_pk):
+        """
+        Directory holding the RRD files of the given object type and primary
+        key, on the root it is placed on by consistent hashing.
+        """
+        root = get_ring(cls.rrd_roots()).get_node('%s/%s' % (obj_type, obj_pk))
+        return os.path.join(root, obj_type, obj_pk)
 
     def _cache_key(self, obj):
         """
@@ -155,6 +251,12 @@ class Metric(models.Model):
         """
         obj_type = obj.__class__.__name__.lower()
         obj_pk = str(obj.pk).replace(':', '')
+        return self._cache_key_for(obj_type, obj_pk)
+
+    def _cache_key_for(self, obj_type, obj_pk):
+        """
+        Cache key for the given object type and primary key.
+        """
         return '%s/%s/%s/%s' % (self.cache_prefix, obj_type, obj_pk, self.pk)
 
     def __unicode__(self):
@@ -166,6 +268,44 @@ class Metric(models.Model):
         verbose_name_plural = _('metrics')
 
 
+def create_rrd(filepath, ds_name, heartbeat=None, start=None):
+    """
+    Creates an RRD file with a single data source, along with its directory.
+
+    If `start` is given, the file accepts updates after that time instead
+    of after the current time. Returns False if the file already exists.
+    """
+    if heartbeat is None:
+        heartbeat = getattr(settings, 'TIMEGRAPH_HEARTBEAT', 300)
+    try:
+        os.makedirs(os.path.dirname(filepath))
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+    options = []
+    if start is not None:
+        options += ['--start', str(start)]
+    options += ['DS:%s:GAUGE:%s:U:U' % (ds_name, heartbeat)] + list(RRD_ARCHIVES)
+
+    # create the file under a temporary name and link it into place, so
+    # that concurrent creators neither clobber each other nor expose a
+    # partially written file
+    tmp_path = '%s.%s.tmp' % (filepath, uuid.uuid4().hex)
+    try:
+        rrdtool.create(str(tmp_path), *options)
+        try:
+            os.link(tmp_path, filepath)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+            return False
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return True
+
+
 def format_with_prefix(value, unit):
     """
     Formats a float value with the appropriate SI prefix.
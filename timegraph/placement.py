@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+#
+# django-timegraph - monitoring graphs for django
+# Copyright (c) 2011-2012, Wifirst
+# Copyright (c) 2013, Jeremy Lainé
+# All rights reserved.
+#
+# See AUTHORS file for a full list of contributors.
+#
+# Redistribution and use in source and binary forms, with or without modification,
+# are permitted provided that the following conditions are met:
+#
+#     1. Redistributions of source code must retain the above copyright notice,
+#        this list of conditions and the following disclaimer.
+#
+#     2. Redistributions in binary form must reproduce the above copyright
+#        notice, this list of conditions and the following disclaimer in the
+#        documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR
+# ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+# ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+import bisect
+import hashlib
+import threading
+
+
+class HashRing(object):
+    """
+    Places keys on a set of nodes by consistent hashing.
+
+    Each node is hashed to `replicas` points of a ring, and a key belongs
+    to the first node point following its own hash, so that adding or
+    removing a node only moves the keys of the ring arcs it takes or gives
+    back, about 1/N of them.
+    """
+    def __init__(self, nodes, replicas=128):
+        self.nodes = list(nodes)
+        points = []
+        for node in self.nodes:
+            for i in range(replicas):
+                points.append((self._hash('%s#%d' % (node, i)), node))
+        points.sort()
+        self.hashes = [point[0] for point in points]
+        self.points = [point[1] for point in points]
+
+    def get_node(self, key):
+        """
+        Returns the node holding the given key.
+        """
+        if len(self.nodes) == 1:
+            return self.nodes[0]
+        i = bisect.bisect(self.hashes, self._hash(key)) % len(self.hashes)
+        return self.points[i]
+
+    def _hash(self, value):
+        return int(hashlib.md5(value.encode('utf-8')).hexdigest()[:16], 16)
+
+
+_rings = {}
+_rings_lock = threading.Lock()
+
+
+def get_ring(nodes):
+    """
+    Returns the ring for the given nodes, which is built only once.
+    """
+    nodes = tuple(nodes)
+    with _rings_lock:
+        if nodes not in _rings:
+            _rings[nodes] = HashRing(nodes)
+        return _rings[nodes]
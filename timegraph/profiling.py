@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+#
+# django-timegraph - monitoring graphs for django
+# Copyright (c) 2011-2012, Wifirst
+# Copyright (c) 2013, Jeremy Lainé
+# All rights reserved.
+#
+# See AUTHORS file for a full list of contributors.
+#
+# Redistribution and use in source and binary forms, with or without modification,
+# are permitted provided that the following conditions are met:
+#
+#     1. Redistributions of source code must retain the above copyright notice, 
+#        this list of conditions and the following disclaimer.
+#     
+#     2. Redistributions in binary form must reproduce the above copyright 
+#        notice, this list of conditions and the following disclaimer in the
+#        documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR
+# ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+# ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import cProfile
+import json
+import pstats
+import time
+from contextlib import contextmanager
+
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+from django.http import HttpResponse
+
+# values of the 'profile' query parameter or X-Timegraph-Profile header
+PROFILE_MODES = {
+    '1': 'headers',
+    'headers': 'headers',
+    'json': 'json',
+    'cprofile': 'cprofile',
+}
+
+
+class _NullPhase(object):
+    def __enter__(self):
+        pass
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+class NullProfiler(object):
+    """
+    A profiler which records nothing, used when profiling is disabled.
+    """
+    _phase = _NullPhase()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+    def phase(self, name):
+        return self._phase
+
+    def finish(self, response):
+        return response
+
+
+class Profiler(object):
+    """
+    A profiler which records the time spent in each phase of a request.
+
+    In 'headers' mode the timings are added to the response in the
+    X-Timegraph-Profile header, in 'json' mode they replace the response
+    body, and 'cprofile' mode additionally includes cProfile statistics.
+
+    The profiled view runs in a `with` block on the profiler, which stops
+    cProfile even if the view raises an exception.
+    """
+    def __init__(self, mode):
+        self.mode = mode
+        self.phases = []
+        self.timings = {}
+        self.start = time.time()
+        if mode == 'cprofile':
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+        else:
+            self.profile = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def stop(self):
+        """
+        Stops collecting cProfile statistics.
+        """
+        if self.profile:
+            self.profile.disable()
+
+    @contextmanager
+    def phase(self, name):
+        """
+        Records the time spent in the enclosed block.
+        """
+        start = time.time()
+        try:
+            yield
+        finally:
+            if name not in self.timings:
+                self.phases.append(name)
+                self.timings[name] = 0.0
+            self.timings[name] += time.time() - start
+
+    def finish(self, response):
+        """
+        Returns the response with the profiling results attached.
+        """
+        total = time.time() - self.start
+        self.stop()
+
+        if self.mode == 'headers':
+            response['X-Timegraph-Profile'] = ', '.join(
+                ['%s=%.2fms' % (name, self.timings[name] * 1000) for name in self.phases] +
+                ['total=%.2fms' % (total * 1000)])
+            return response
+
+        result = {
+            'status': response.status_code,
+            'total': total,
+            'phases': [{'name': name, 'time': self.timings[name]} for name in self.phases],
+        }
+        if self.profile:
+            stream = StringIO()
+            pstats.Stats(self.profile, stream=stream).sort_stats('cumulative').print_stats(50)
+            result['profile'] = stream.getvalue()
+        return HttpResponse(json.dumps(result), content_type='application/json')
+
+
+NULL_PROFILER = NullProfiler()
+
+
+def get_profiler(request):
+    """
+    Returns the profiler for the given request.
+
+    Profiling is enabled for staff users by the 'profile' query parameter
+    or the X-Timegraph-Profile header.
+    """
+    mode = request.GET.get('profile') or request.META.get('HTTP_X_TIMEGRAPH_PROFILE')
+    if mode not in PROFILE_MODES:
+        return NULL_PROFILER
+    user = getattr(request, 'user', None)
+    if user is None or not user.is_staff:
+        return NULL_PROFILER
+    return Profiler(PROFILE_MODES[mode])
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+#
+# django-timegraph - monitoring graphs for django
+# Copyright (c) 2011-2012, Wifirst
+# Copyright (c) 2013, Jeremy Lainé
+# All rights reserved.
+#
+# See AUTHORS file for a full list of contributors.
+#
+# Redistribution and use in source and binary forms, with or without modification,
+# are permitted provided that the following conditions are met:
+#
+#     1. Redistributions of source code must retain the above copyright notice, 
+#        this list of conditions and the following disclaimer.
+#     
+#     2. Redistributions in binary form must reproduce the above copyright 
+#        notice, this list of conditions and the following disclaimer in the
+#        documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR
+# ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+# ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import multiprocessing
+import os
+
+from timegraph.export import _chunks
+from timegraph.storage import get_backend
+
+
+def _create(args):
+    """
+    Creates a single RRD file, returning False if it already exists.
+    """
+    filepath, backend_name, ds_name = args
+    if os.path.exists(filepath):
+        return False
+    return get_backend(backend_name).create(filepath, ds_name)
+
+
+def provision(metrics, object_list, chunk_size=1000, processes=None, progress=None):
+    """
+    Creates the missing RRD files of the given metrics for the given
+    objects, using a pool of `processes` workers.
+
+    Existing files are left untouched, so an interrupted run can simply be
+    started again. After each chunk of objects, `progress` is called with
+    the number of processed objects, the number of created files and the
+    last processed object.
+
+    Returns the number of processed objects and of created files.
+    """
+    metrics = [metric for metric in metrics if metric.rrd_enabled]
+    objects = 0
+    created = 0
+
+    pool = multiprocessing.Pool(processes)
+    try:
+        for chunk in _chunks(object_list, chunk_size):
+            tasks = [(metric.rrd_path(obj), metric.backend_name, metric.pk) for obj in chunk for metric in metrics]
+            created += sum(pool.imap_unordered(_create, tasks, 16))
+            objects += len(chunk)
+            if progress:
+                progress(objects, created, chunk[-1])
+    finally:
+        pool.close()
+        pool.join()
+
+    return objects, created
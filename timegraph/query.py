@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+#
+# django-timegraph - monitoring graphs for django
+# Copyright (c) 2011-2012, Wifirst
+# Copyright (c) 2013, Jeremy Lainé
+# All rights reserved.
+#
+# See AUTHORS file for a full list of contributors.
+#
+# Redistribution and use in source and binary forms, with or without modification,
+# are permitted provided that the following conditions are met:
+#
+#     1. Redistributions of source code must retain the above copyright notice, 
+#        this list of conditions and the following disclaimer.
+#     
+#     2. Redistributions in binary form must reproduce the above copyright 
+#        notice, this list of conditions and the following disclaimer in the
+#        documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR
+# ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+# ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import heapq
+import itertools
+import multiprocessing
+import os
+from multiprocessing.pool import ThreadPool
+
+import numpy
+
+from timegraph.export import _chunks
+from timegraph.storage import get_backend
+
+
+def reduce_series(values, reduction='avg', percentile=95):
+    """
+    Reduces the given values to a single number, ignoring unknown values.
+
+    Returns None if all the values are unknown.
+    """
+    values = values[~numpy.isnan(values)]
+    if not len(values):
+        return None
+
+    if reduction == 'avg':
+        return float(values.mean())
+    elif reduction == 'max':
+        return float(values.max())
+    elif reduction == 'min':
+        return float(values.min())
+    elif reduction == 'last':
+        return float(values[-1])
+    elif reduction == 'percentile':
+        return float(numpy.percentile(values, percentile))
+    else:
+        raise ValueError('Unknown reduction %r' % reduction)
+
+
+def _reduce(args):
+    """
+    Fetches and reduces a single RRD file, returning None if it does not exist.
+    """
+    filepath, backend_name, cf, start, end, reduction, percentile = args
+    if not os.path.exists(filepath):
+        return None
+    timestamps, values = get_backend(backend_name).fetch(filepath, cf, start, end)
+    return reduce_series(values, reduction, percentile)
+
+
+def top_objects(metric, object_list, start=-3600, end=-1, reduction='avg', percentile=95,
+                count=50, bottom=False, chunk_size=1000, processes=None, threads=None):
+    """
+    Returns the `count` objects with the highest value of the metric over
+    the given time range, or the lowest if `bottom` is True.
+
+    The value of each object is the reduction ('avg', 'max', 'min', 'last'
+    or 'percentile') of its series. RRD files are read and reduced by a
+    pool of `processes` workers, and only the current winners are kept.
+    Web requests should rather pass a number of `threads`, which are used
+    instead of forking the serving process.
+
+    The result is a list of (object, value) tuples, best first.
+    """
+    if count < 1:
+        return []
+    cf = (reduction == 'max') and 'MAX' or 'AVERAGE'
+    counter = itertools.count()
+    heap = []
+
+    if threads:
+        pool = ThreadPool(threads)
+    else:
+        pool = multiprocessing.Pool(processes)
+    try:
+        for chunk in _chunks(object_list, chunk_size):
+            tasks = [(metric.rrd_path(obj), metric.backend_name, cf, start, end, reduction, percentile)
+                     for obj in chunk]
+            for obj, value in zip(chunk, pool.imap(_reduce, tasks)):
+                if value is None:
+                    continue
+                if bottom:
+                    item = (-value, next(counter), obj, value)
+                else:
+                    item = (value, next(counter), obj, value)
+                if len(heap) < count:
+                    heapq.heappush(heap, item)
+                elif item[0] > heap[0][0]:
+                    heapq.heapreplace(heap, item)
+    finally:
+        pool.close()
+        pool.join()
+
+    # ties are resolved in favour of the first objects
+    heap.sort(key=lambda item: (item[0], -item[1]), reverse=True)
+    return [(obj, value) for key, index, obj, value in heap]
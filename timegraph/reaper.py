@@ -0,0 +1,326 @@
+# -*- coding: utf-8 -*-
+#
+# django-timegraph - monitoring graphs for django
+# Copyright (c) 2011-2012, Wifirst
+# Copyright (c) 2013, Jeremy Lainé
+# All rights reserved.
+#
+# See AUTHORS file for a full list of contributors.
+#
+# Redistribution and use in source and binary forms, with or without modification,
+# are permitted provided that the following conditions are met:
+#
+#     1. Redistributions of source code must retain the above copyright notice, 
+#        this list of conditions and the following disclaimer.
+#     
+#     2. Redistributions in binary form must reproduce the above copyright 
+#        notice, this list of conditions and the following disclaimer in the
+#        documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR
+# ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+# ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import errno
+import os
+import rrdtool
+import shutil
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.db import connection
+
+from timegraph.models import Metric
+from timegraph.storage import get_backend_for
+
+try:
+    from os import scandir
+except ImportError:
+    from scandir import scandir
+
+try:
+    from django.apps import apps
+    get_models = apps.get_models
+except ImportError:
+    from django.db.models import get_models
+
+
+def _pk_candidates(name):
+    """
+    Returns the primary keys which may have produced the given directory
+    name. Colons are stripped from RRD paths, so a bare MAC address also
+    matches its colon-separated form.
+    """
+    candidates = [name]
+    if len(name) == 12:
+        try:
+            int(name, 16)
+        except ValueError:
+            pass
+        else:
+            candidates.append(':'.join(name[i:i + 2] for i in range(0, 12, 2)))
+    return candidates
+
+
+def _accepts_colons(field):
+    """
+    Returns whether values of the given field may hold colons.
+    """
+    try:
+        return field.to_python('a:b') == 'a:b'
+    except ValidationError:
+        return False
+
+
+class RateLimiter(object):
+    """
+    Limits the rate of operations performed by a set of threads.
+    """
+    def __init__(self, rate):
+        self.interval = rate and 1.0 / rate or 0
+        self.lock = threading.Lock()
+        self.next_time = 0
+
+    def wait(self):
+        """
+        Blocks until the next operation is allowed.
+        """
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.time()
+            delay = self.next_time - now
+            self.next_time = max(now, self.next_time) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+class Reaper(object):
+    """
+    Removes the RRD files and cached values of deleted objects, and
+    optionally the RRD files which have not been updated for `days` days.
+
+    Object directories are checked against the database in batches, and
+    after each batch the position in the tree is saved to `cursor_path`
+    so that an interrupted run resumes where it stopped. Removed files are
+    moved to `archive_root` if it is set.
+    """
+    def __init__(self, root=None, days=None, archive_root=None, cursor_path=None,
+                 batch_size=500, workers=4, rate=None, dry_run=False):
+        self.roots = root and [root] or Metric.rrd_roots()
+        self.days = days
+        self.archive_root = archive_root
+        self.cursor_path = cursor_path
+        self.batch_size = batch_size
+        self.workers = workers
+        self.limiter = RateLimiter(rate)
+        self.dry_run = dry_run
+
+    def run(self):
+        """
+        Walks the RRD tree and returns a dictionary with the number of
+        removed 'objects' and stale 'files', and the list of 'skipped'
+        object types which could not be matched to a single model.
+        """
+        stats = {'objects': 0, 'files': 0, 'skipped': []}
+        if self.days:
+            self.cutoff = time.time() - self.days * 86400
+        else:
+            self.cutoff = None
+
+        models = {}
+        for model in get_models():
+            models.setdefault(model.__name__.lower(), []).append(model)
+
+        roots = [root for root in self.roots if os.path.isdir(root)]
+        if not roots:
+            return stats
+
+        cursor = self._read_cursor()
+        pool = ThreadPool(self.workers)
+        try:
+            for obj_type in sorted(self._list_dirs(roots)):
+                if cursor and obj_type < cursor[0]:
+                    continue
+                if len(models.get(obj_type, [])) != 1:
+                    stats['skipped'].append(obj_type)
+                    continue
+                model = models[obj_type][0]
+
+                names = sorted(self._list_dirs([os.path.join(root, obj_type) for root in roots]))
+                if cursor and obj_type == cursor[0]:
+                    names = [name for name in names if name > cursor[1]]
+
+                for i in range(0, len(names), self.batch_size):
+                    batch = names[i:i + self.batch_size]
+                    orphans = self._orphans(model, batch)
+                    tasks = [(obj_type, name, name in orphans) for name in batch]
+                    for objects, files in pool.imap_unordered(self._reap, tasks):
+                        stats['objects'] += objects
+                        stats['files'] += files
+                    self._write_cursor(obj_type, batch[-1])
+        finally:
+            pool.close()
+            pool.join()
+
+        self._write_cursor(None, None)
+        return stats
+
+    def _list_dirs(self, paths):
+        """
+        Returns the names of the directories found in any of the given paths.
+        """
+        names = set()
+        for path in paths:
+            if os.path.isdir(path):
+                names.update(entry.name for entry in scandir(path) if entry.is_dir())
+        return names
+
+    def _orphans(self, model, names):
+        """
+        Returns the directory names which do not match any existing object.
+
+        Colons are stripped from RRD paths, so if primary keys may hold
+        colons, the names which do not match a primary key as such are
+        compared with every primary key stripped of its colons.
+        """
+        candidates = {}
+        for name in names:
+            for value in _pk_candidates(name):
+                try:
+                    candidates[model._meta.pk.to_python(value)] = name
+                except ValidationError:
+                    pass
+        pks = model._default_manager.filter(pk__in=list(candidates)).values_list('pk', flat=True)
+        live = set(str(pk).replace(':', '') for pk in pks)
+        orphans = set(candidates.values()) - live
+        if orphans and _accepts_colons(model._meta.pk):
+            qn = connection.ops.quote_name
+            where = 'REPLACE(%s.%s, %%s, %%s) IN (%s)' % (
+                qn(model._meta.db_table), qn(model._meta.pk.column), ', '.join(['%s'] * len(orphans)))
+            pks = model._default_manager.extra(where=[where], params=[':', ''] + sorted(orphans))
+            orphans -= set(str(pk).replace(':', '') for pk in pks.values_list('pk', flat=True))
+        return orphans
+
+    def _reap(self, task):
+        """
+        Processes a single object directory on each root, returning the
+        number of removed objects and stale files.
+        """
+        obj_type, obj_pk, is_orphan = task
+        dirpaths = [(root, os.path.join(root, obj_type, obj_pk)) for root in self.roots]
+        dirpaths = [(root, dirpath) for root, dirpath in dirpaths if os.path.isdir(dirpath)]
+
+        if is_orphan:
+            names = [os.path.splitext(entry.name)[0]
+                     for root, dirpath in dirpaths for entry in scandir(dirpath)]
+            keys = [Metric(pk=name)._cache_key_for(obj_type, obj_pk) for name in names if name.isdigit()]
+            self.limiter.wait()
+            if not self.dry_run:
+                cache.delete_many(keys)
+                for root, dirpath in dirpaths:
+                    self._remove(root, dirpath)
+            return 1, 0
+
+        files = 0
+        if self.cutoff:
+            for root, dirpath in dirpaths:
+                removed = 0
+                for entry in scandir(dirpath):
+                    if entry.is_file() and self._last_update(entry) < self.cutoff:
+                        self.limiter.wait()
+                        if not self.dry_run:
+                            self._remove(root, entry.path)
+                        removed += 1
+                if removed and not self.dry_run:
+                    try:
+                        os.rmdir(dirpath)
+                    except OSError:
+                        pass
+                files += removed
+        return 0, files
+
+    def _last_update(self, entry):
+        """
+        Returns the time of the last update of the given file, as told by
+        its storage backend, or else its modification time.
+        """
+        backend = get_backend_for(entry.path)
+        if backend is not None:
+            try:
+                return backend.last(entry.path)
+            except (rrdtool.error, ValueError):
+                pass
+        return entry.stat().st_mtime
+
+    def _remove(self, root, path):
+        """
+        Deletes the given file or directory, or moves it to the archive.
+
+        The files of series are deleted by their storage backend, so that
+        it lets go of them.
+        """
+        if os.path.isdir(path):
+            for entry in scandir(path):
+                self._remove(root, entry.path)
+            os.rmdir(path)
+            return
+
+        if self.archive_root:
+            target = os.path.join(self.archive_root, os.path.relpath(path, root))
+            if os.path.exists(target):
+                target = '%s.%d' % (target, time.time())
+            try:
+                os.makedirs(os.path.dirname(target))
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+            try:
+                os.link(path, target)
+            except OSError as e:
+                if e.errno != errno.EXDEV:
+                    raise
+                shutil.copy2(path, target)
+
+        backend = get_backend_for(path)
+        if backend is not None:
+            backend.delete(path)
+        else:
+            os.remove(path)
+
+    def _read_cursor(self):
+        """
+        Returns the (type, pk) position saved by an interrupted run.
+        """
+        if not self.cursor_path or not os.path.exists(self.cursor_path):
+            return None
+        with open(self.cursor_path) as fp:
+            value = fp.read().strip()
+        if '/' not in value:
+            return None
+        return tuple(value.split('/', 1))
+
+    def _write_cursor(self, obj_type, obj_pk):
+        """
+        Saves the current position, or clears it once the walk is complete.
+        """
+        if not self.cursor_path or self.dry_run:
+            return
+        if obj_type is None:
+            if os.path.exists(self.cursor_path):
+                os.remove(self.cursor_path)
+            return
+        tmp_path = self.cursor_path + '.tmp'
+        with open(tmp_path, 'w') as fp:
+            fp.write('%s/%s\n' % (obj_type, obj_pk))
+        os.rename(tmp_path, self.cursor_path)
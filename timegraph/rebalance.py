@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+#
+# django-timegraph - monitoring graphs for django
+# Copyright (c) 2011-2012, Wifirst
+# Copyright (c) 2013, Jeremy Lainé
+# All rights reserved.
+#
+# See AUTHORS file for a full list of contributors.
+#
+# Redistribution and use in source and binary forms, with or without modification,
+# are permitted provided that the following conditions are met:
+#
+#     1. Redistributions of source code must retain the above copyright notice,
+#        this list of conditions and the following disclaimer.
+#
+#     2. Redistributions in binary form must reproduce the above copyright
+#        notice, this list of conditions and the following disclaimer in the
+#        documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR
+# ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+# ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+import errno
+import os
+import shutil
+import time
+import uuid
+
+from timegraph.locking import lock_file
+from timegraph.models import Metric
+
+try:
+    from os import scandir
+except ImportError:
+    from scandir import scandir
+
+
+def rebalance(dry_run=False, progress=None):
+    """
+    Moves the object directories which are not on the RRD root they are
+    placed on, for instance after a root was added to TIMEGRAPH_RRD_ROOT.
+
+    Files are moved one at a time while holding their lock, so values can
+    still be injected during the run: while TIMEGRAPH_RRD_REBALANCING is
+    set, a file which is not moved yet is found by looking up the other
+    roots. After each moved directory,
+    `progress` is called with the object type and directory name.
+
+    A file which already exists on its new root, for instance because a
+    value was injected before the old one was moved, is replaced by the old
+    one, which holds the history, and set aside with a '.conflict' suffix.
+
+    Returns the number of moved objects and files, and of files set aside.
+    """
+    objects = 0
+    files = 0
+    conflicts = 0
+    for root in Metric.rrd_roots():
+        if not os.path.isdir(root):
+            continue
+        for type_entry in scandir(root):
+            if not type_entry.is_dir():
+                continue
+            for obj_entry in scandir(type_entry.path):
+                if not obj_entry.is_dir():
+                    continue
+                target = Metric.rrd_dir(type_entry.name, obj_entry.name)
+                if target == obj_entry.path:
+                    continue
+                objects += 1
+                if not dry_run:
+                    moved, set_aside = _move_dir(obj_entry.path, target)
+                    files += moved
+                    conflicts += set_aside
+                if progress:
+                    progress(type_entry.name, obj_entry.name)
+    return objects, files, conflicts
+
+
+def _move_dir(source, target):
+    """
+    Moves the files of an object directory to its new location, returning
+    the number of moved files and of files set aside.
+    """
+    try:
+        os.makedirs(target)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+    moved = 0
+    set_aside = 0
+    for entry in scandir(source):
+        if not entry.is_file() or entry.name.endswith('.tmp'):
+            continue
+        result = _move_file(entry.path, os.path.join(target, entry.name))
+        if result:
+            moved += 1
+        if result == 'conflict':
+            set_aside += 1
+
+    try:
+        os.rmdir(source)
+    except OSError:
+        pass
+    return moved, set_aside
+
+
+def _move_file(source, target):
+    """
+    Copies a file to its new location and removes it, while holding its
+    lock so that no update is lost.
+
+    Returns 'moved', or 'conflict' if a file already existed at the new
+    location and was set aside, or None if the file was removed meanwhile.
+    """
+    tmp_path = '%s.%s.tmp' % (target, uuid.uuid4().hex)
+    try:
+        with lock_file(source, create=False):
+            shutil.copy2(source, tmp_path)
+            try:
+                os.link(tmp_path, target)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+                # the existing file is copied rather than renamed, so that
+                # its writers see it was unlinked and look it up again
+                with lock_file(target, create=False):
+                    shutil.copy2(target, '%s.%d.conflict' % (target, time.time()))
+                    os.rename(tmp_path, target)
+                os.remove(source)
+                return 'conflict'
+            os.remove(source)
+    except OSError as e:
+        # the file was removed meanwhile
+        if e.errno != errno.ENOENT:
+            raise
+        return None
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return 'moved'
@@ -0,0 +1,249 @@
+# -*- coding: utf-8 -*-
+#
+# django-timegraph - monitoring graphs for django
+# Copyright (c) 2011-2012, Wifirst
+# Copyright (c) 2013, Jeremy Lainé
+# All rights reserved.
+#
+# See AUTHORS file for a full list of contributors.
+#
+# Redistribution and use in source and binary forms, with or without modification,
+# are permitted provided that the following conditions are met:
+#
+#     1. Redistributions of source code must retain the above copyright notice,
+#        this list of conditions and the following disclaimer.
+#
+#     2. Redistributions in binary form must reproduce the above copyright
+#        notice, this list of conditions and the following disclaimer in the
+#        documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR
+# ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+# ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+import mmap
+import os
+import struct
+import time
+
+import numpy
+
+# value of the float cookie, used to check the file's byte order and layout
+FLOAT_COOKIE = 8.642135E130
+
+# native layout of the structures in an RRD file, see rrd_format.h
+STAT_HEAD = struct.Struct('@4s5sdLLL80x')
+DS_DEF = struct.Struct('@20s20s80x')
+RRA_DEF = struct.Struct('@20sLL80x')
+LIVE_HEAD = struct.Struct('@ll')
+PDP_PREP_SIZE = struct.calcsize('@30s0d') + 80
+CDP_PREP_SIZE = 80
+RRA_PTR = struct.Struct('@L')
+
+
+def _string(value):
+    return value.split(b'\0', 1)[0].decode('ascii')
+
+
+class RRDArchive(object):
+    """
+    A round robin archive of an RRD file.
+
+    `data` is a read-only view of the archive's ring buffer in the file,
+    with one row per consolidated data point and one column per data
+    source. The current row is read from the file on each access, so the
+    archive follows the updates made after the file was opened.
+    """
+    def __init__(self, rrd, cf, row_cnt, pdp_cnt, data, ptr_offset):
+        self.rrd = rrd
+        self.cf = cf
+        self.row_cnt = row_cnt
+        self.pdp_cnt = pdp_cnt
+        self.step = rrd.step * pdp_cnt
+        self.data = data
+        self.ptr_offset = ptr_offset
+
+    @property
+    def cur_row(self):
+        """
+        Index in `data` of the most recent row.
+        """
+        return RRA_PTR.unpack_from(self.rrd.map, self.ptr_offset)[0]
+
+    def end_time(self, last_update=None):
+        """
+        Returns the UNIX timestamp of the most recent row.
+        """
+        if last_update is None:
+            last_update = self.rrd.last_update()
+        return last_update - last_update % self.step
+
+    def segments(self):
+        """
+        Returns the older and newer parts of the ring buffer, as zero-copy
+        views which hold the rows in chronological order once put end to
+        end.
+        """
+        cur_row = self.cur_row
+        return self.data[cur_row + 1:], self.data[:cur_row + 1]
+
+    def series(self, ds=0):
+        """
+        Returns the (timestamps, values) of the whole archive for the given
+        data source, in chronological order. Unlike :meth:`segments`, this
+        copies the values.
+        """
+        older, newer = self.segments()
+        values = numpy.concatenate([older[:, ds], newer[:, ds]])
+        end = self.end_time()
+        timestamps = end - self.step * numpy.arange(self.row_cnt - 1, -1, -1, dtype=numpy.int64)
+        return timestamps, values
+
+
+class RRDFile(object):
+    """
+    A read-only, memory-mapped RRD file.
+
+    The header is parsed once when the file is opened, and the archives
+    expose their ring buffers as NumPy views of the mapped file, so reading
+    many files copies only the rows actually used. Files must have been
+    written by rrdtool on a machine with the same architecture.
+    """
+    def __init__(self, filepath):
+        self.filepath = filepath
+        fd = os.open(filepath, os.O_RDONLY)
+        try:
+            self.map = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+        finally:
+            os.close(fd)
+        try:
+            self._parse()
+        except Exception:
+            self.close()
+            raise
+
+    def _parse(self):
+        cookie, version, float_cookie, ds_cnt, rra_cnt, pdp_step = STAT_HEAD.unpack_from(self.map, 0)
+        if cookie != b'RRD\0':
+            raise ValueError('%s is not an RRD file' % self.filepath)
+        if float_cookie != FLOAT_COOKIE:
+            raise ValueError('%s was not written on a compatible architecture' % self.filepath)
+        self.version = int(_string(version))
+        self.step = pdp_step
+        offset = STAT_HEAD.size
+
+        self.ds_names = []
+        for i in range(ds_cnt):
+            name, dst = DS_DEF.unpack_from(self.map, offset)
+            self.ds_names.append(_string(name))
+            offset += DS_DEF.size
+
+        rra_defs = []
+        for i in range(rra_cnt):
+            cf, row_cnt, pdp_cnt = RRA_DEF.unpack_from(self.map, offset)
+            rra_defs.append((_string(cf), row_cnt, pdp_cnt))
+            offset += RRA_DEF.size
+
+        # versions before 3 do not store the microseconds of the last update
+        self.live_offset = offset
+        if self.version >= 3:
+            offset += LIVE_HEAD.size
+        else:
+            offset += struct.calcsize('@l')
+        offset += PDP_PREP_SIZE * ds_cnt
+        offset += CDP_PREP_SIZE * ds_cnt * rra_cnt
+        ptr_offset = offset
+        offset += RRA_PTR.size * rra_cnt
+
+        self.archives = []
+        for i, (cf, row_cnt, pdp_cnt) in enumerate(rra_defs):
+            data = numpy.frombuffer(self.map, dtype=numpy.float64, count=row_cnt * ds_cnt, offset=offset)
+            self.archives.append(RRDArchive(self, cf, row_cnt, pdp_cnt, data.reshape(row_cnt, ds_cnt),
+                                            ptr_offset + i * RRA_PTR.size))
+            offset += data.nbytes
+        if offset != len(self.map):
+            raise ValueError('%s has an unexpected size' % self.filepath)
+
+    def last_update(self):
+        """
+        Returns the UNIX timestamp of the last update.
+        """
+        return struct.unpack_from('@l', self.map, self.live_offset)[0]
+
+    def choose_archive(self, cf, start, end, resolution=None):
+        """
+        Returns the archive rrdtool's fetch reads for the given consolidation
+        function, time range and resolution: the one closest to the
+        resolution among those covering the time range, or else the one
+        covering most of it.
+        """
+        last_update = self.last_update()
+        best_full = best_part = None
+        for archive in self.archives:
+            if archive.cf != cf:
+                continue
+            step_diff = abs((resolution or 1) - archive.step)
+            last = archive.end_time(last_update)
+            first = last - archive.step * archive.row_cnt
+            if first <= start and last >= end:
+                if best_full is None or step_diff < best_full[0]:
+                    best_full = (step_diff, archive)
+            else:
+                match = end - start - max(first - start, 0) - max(end - last, 0)
+                if best_part is None or (-match, step_diff) < best_part[0]:
+                    best_part = ((-match, step_diff), archive)
+        if best_full is not None:
+            return best_full[1]
+        if best_part is not None:
+            return best_part[1]
+        raise ValueError('%s has no %s archive' % (self.filepath, cf))
+
+    def fetch(self, cf='AVERAGE', start=-86400, end=-1, resolution=None, ds=0):
+        """
+        Fetches the data of the file like :func:`timegraph.series.fetch_rrd`.
+
+        Returns a (timestamps, values) tuple of numpy arrays, in which unknown
+        values are NaN.
+        """
+        now = int(time.time())
+        start = int(start) < 0 and now + int(start) or int(start)
+        end = int(end) < 0 and now + int(end) or int(end)
+        archive = self.choose_archive(cf, start, end, resolution)
+        step = archive.step
+        start -= start % step
+        end += step - end % step
+
+        # a row is timestamped with the end of the interval it covers
+        timestamps = numpy.arange(start + step, end + step, step, dtype=numpy.int64)
+        last = archive.end_time()
+        index = (timestamps - (last - step * (archive.row_cnt - 1))) // step
+        valid = (index >= 0) & (index < archive.row_cnt)
+        values = numpy.empty(len(timestamps), dtype=numpy.float64)
+        values.fill(numpy.nan)
+        values[valid] = archive.data[(archive.cur_row + 1 + index[valid]) % archive.row_cnt, ds]
+        return timestamps, values
+
+    def close(self):
+        """
+        Unmaps the file. Views of its archives must no longer be used.
+        """
+        self.archives = []
+        try:
+            self.map.close()
+        except BufferError:
+            # views are still referenced, the file is unmapped once they are released
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
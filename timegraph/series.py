@@ -0,0 +1,477 @@
+# -*- coding: utf-8 -*-
+#
+# django-timegraph - monitoring graphs for django
+# Copyright (c) 2011-2012, Wifirst
+# Copyright (c) 2013, Jeremy Lainé
+# All rights reserved.
+#
+# See AUTHORS file for a full list of contributors.
+#
+# Redistribution and use in source and binary forms, with or without modification,
+# are permitted provided that the following conditions are met:
+#
+#     1. Redistributions of source code must retain the above copyright notice, 
+#        this list of conditions and the following disclaimer.
+#     
+#     2. Redistributions in binary form must reproduce the above copyright 
+#        notice, this list of conditions and the following disclaimer in the
+#        documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR
+# ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+# ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import atexit
+import calendar
+import errno
+import io
+import os
+import tempfile
+import threading
+import time
+import zipfile
+from collections import OrderedDict
+
+import numpy
+import rrdtool
+from django.conf import settings
+
+from timegraph.models import Metric, RRD_ARCHIVES, RRD_STEP
+from timegraph.rrdfile import RRDFile
+
+# read RRD files directly rather than through librrd
+native_reader = getattr(settings, 'TIMEGRAPH_NATIVE_READER', False)
+
+
+def resolve_time(value, now=None):
+    """
+    Converts a time given as in rrdtool, where negative values are relative
+    to the current time, to a UNIX timestamp.
+    """
+    value = int(value)
+    if value < 0:
+        if now is None:
+            now = time.time()
+        value += int(now)
+    return value
+
+
+def fetch_rrd(filepath, cf='AVERAGE', start=-86400, end=-1, resolution=None):
+    """
+    Fetches the data of the given RRD file.
+
+    Returns a (timestamps, values) tuple of numpy arrays, in which unknown
+    values are NaN.
+    """
+    if native_reader:
+        with RRDFile(filepath) as rrd:
+            return rrd.fetch(cf, start, end, resolution)
+
+    args = [str(filepath), str(cf), '--start', str(start), '--end', str(end)]
+    if resolution:
+        args += ['--resolution', str(resolution)]
+    (first, last, step), names, rows = rrdtool.fetch(*args)
+
+    # a row is timestamped with the end of the interval it covers
+    timestamps = first + step * numpy.arange(1, len(rows) + 1, dtype=numpy.int64)
+    values = numpy.array(rows, dtype=numpy.float64).reshape(len(rows), len(names))
+    return timestamps, values[:, 0]
+
+
+def fetch_series(filepath, cf='AVERAGE', start=-86400, end=-1, resolution=None):
+    """
+    Fetches the data of the given RRD file, completed with archived data
+    if the time range starts before the oldest data the file can hold.
+
+    Returns a (timestamps, values) tuple of numpy arrays, in which unknown
+    values are NaN. If archived data is included, the timestamps may not
+    be evenly spaced.
+    """
+    timestamps, values = fetch_rrd(filepath, cf, start, end, resolution)
+    first = archive_boundary(filepath, start, cf)
+    if first is None:
+        return timestamps, values
+
+    archived_timestamps, archived_values = read_archive(
+        filepath, cf, resolve_time(start), min(resolve_time(end), first))
+    mask = timestamps > first
+    return (numpy.concatenate([archived_timestamps, timestamps[mask]]),
+            numpy.concatenate([archived_values, values[mask]]))
+
+
+def archive_boundary(filepath, start, cf='AVERAGE'):
+    """
+    Returns the time before which data for a range beginning at `start`
+    must be read from the archives, or None if the RRD file covers the
+    whole range or archives are disabled.
+    """
+    if not Metric.archive_root:
+        return None
+
+    # the file covers at least its retention before the current time
+    now = time.time()
+    start = resolve_time(start, now)
+    index, retention = _longest_archive(cf)
+    if start >= now - retention:
+        return None
+    first = rrd_first(filepath, cf)
+    if start >= first:
+        return None
+    return first
+
+
+def _longest_archive(cf):
+    """
+    Returns the index and the duration in seconds of the longest archive
+    of RRD files for the given consolidation function.
+    """
+    archives = []
+    for index, rra in enumerate(RRD_ARCHIVES):
+        kind, rra_cf, xff, steps, rows = rra.split(':')
+        if rra_cf == cf:
+            archives.append((int(steps) * int(rows) * RRD_STEP, index))
+    duration, index = max(archives)
+    return index, duration
+
+
+def rrd_first(filepath, cf='AVERAGE'):
+    """
+    Returns the oldest time covered by the given RRD file for the given
+    consolidation function.
+    """
+    index, duration = _longest_archive(cf)
+    return rrdtool.first(str(filepath), '--rraindex', str(index))
+
+
+def archive_paths(obj_type, year, month):
+    """
+    Paths of the archive segments holding the data of the given object type
+    and month, oldest first.
+    """
+    directory = os.path.join(Metric.archive_root, obj_type)
+    prefix = '%04d-%02d.' % (year, month)
+    try:
+        names = os.listdir(directory)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        return []
+    return [os.path.join(directory, name) for name in sorted(names)
+            if name.startswith(prefix) and name.endswith('.npz')]
+
+
+def archive_prefix(filepath):
+    """
+    Returns the object type, and the prefix of the archive members holding
+    the data of the given RRD file.
+    """
+    obj_type, obj_pk, name = os.path.abspath(filepath).split(os.sep)[-3:]
+    return obj_type, '%s/%s/' % (obj_pk, os.path.splitext(name)[0])
+
+
+def months(start, end):
+    """
+    Yields the (year, month) tuples between the given UNIX timestamps.
+    """
+    year, month = time.gmtime(start)[:2]
+    while calendar.timegm((year, month, 1, 0, 0, 0)) <= end:
+        yield year, month
+        year, month = month == 12 and (year + 1, 1) or (year, month + 1)
+
+
+def read_archive(filepath, cf, start, end):
+    """
+    Reads the archived data of the given RRD file between the given UNIX
+    timestamps.
+
+    Returns a (timestamps, values) tuple of numpy arrays.
+    """
+    obj_type, prefix = archive_prefix(filepath)
+    all_timestamps = [numpy.array([], dtype=numpy.int64)]
+    all_values = [numpy.array([], dtype=numpy.float64)]
+    for year, month in months(start, end):
+        for path in archive_paths(obj_type, year, month):
+            try:
+                archive = zipfile.ZipFile(path)
+            except zipfile.BadZipfile:
+                continue
+            try:
+                if prefix + 'time.npy' not in archive.namelist():
+                    continue
+                timestamps = numpy.load(io.BytesIO(archive.read(prefix + 'time.npy')))
+                values = numpy.load(io.BytesIO(archive.read(prefix + cf + '.npy')))
+            finally:
+                archive.close()
+            mask = (timestamps > start) & (timestamps <= end)
+            all_timestamps.append(timestamps[mask])
+            all_values.append(values[mask])
+            break
+    return numpy.concatenate(all_timestamps), numpy.concatenate(all_values)
+
+
+def series_to_rrd(filepath, ds_name, timestamps, values):
+    """
+    Writes the given series to a new RRD file, with a single archive per
+    consolidation function.
+
+    The series may join archived and live data, so it is resampled to the
+    coarser of the steps at either end.
+    """
+    if len(timestamps) > 1:
+        step = int(max(timestamps[1] - timestamps[0], timestamps[-1] - timestamps[-2]))
+    else:
+        step = 300
+    first = int(timestamps[0]) // step * step
+    grid = numpy.arange(first, int(timestamps[-1]) + step, step, dtype=numpy.int64)
+    values = align_series(timestamps, values, grid)
+
+    rrdtool.create(str(filepath), '--start', str(first - step), '--step', str(step),
+                   'DS:%s:GAUGE:%d:U:U' % (ds_name, 2 * step),
+                   'RRA:AVERAGE:0.5:1:%d' % len(grid),
+                   'RRA:MAX:0.5:1:%d' % len(grid))
+    rrdtool.update(str(filepath), *[
+        str('%d:%s' % (t, numpy.isnan(v) and 'U' or repr(float(v)))) for t, v in zip(grid, values)])
+
+
+def align_series(timestamps, values, grid):
+    """
+    Resamples the given series onto the given timestamps.
+
+    Each point of the grid takes the value of the row covering it, or NaN
+    if the series does not cover it.
+    """
+    result = numpy.empty(len(grid), dtype=numpy.float64)
+    result.fill(numpy.nan)
+    if not len(timestamps):
+        return result
+
+    if len(timestamps) > 1:
+        step = timestamps[1] - timestamps[0]
+    else:
+        step = 1
+    index = numpy.searchsorted(timestamps, grid)
+    mask = (index < len(timestamps)) & (grid > timestamps[0] - step)
+    result[mask] = values[index[mask]]
+    return result
+
+
+class SeriesCache(object):
+    """
+    A bounded LRU cache of fetched series, shared by the threads of a
+    process and holding at most `max_bytes` of arrays.
+
+    Series are keyed by RRD file, consolidation function, time range and
+    resolution. Relative times are rounded down to the RRD step, so that
+    requests made within the same step share their series. The cached
+    arrays are read-only.
+
+    When a relative window moves on to the next step, its series is not
+    read again: only the rows since the previous series are fetched, and
+    the previous series is shifted to make room for them.
+
+    A series may also be kept as a temporary RRD file rrdtool can graph,
+    which counts towards `max_bytes` and is removed along with the series.
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        self.entries = OrderedDict()
+        self.windows = {}
+        self.window_keys = {}
+        self.files = {}
+        self.users = {}
+        self.lock = threading.Lock()
+
+    def _key(self, filepath, cf, start, end, resolution, now):
+        window = None
+        if int(start) < 0 and int(end) < 0:
+            window = (filepath, cf, int(start), int(end), resolution)
+        if int(start) < 0:
+            start = resolve_time(start, now) // RRD_STEP * RRD_STEP
+        if int(end) < 0:
+            end = resolve_time(end, now) // RRD_STEP * RRD_STEP
+        return (filepath, cf, int(start), int(end), resolution), window
+
+    def fetch(self, filepath, cf='AVERAGE', start=-86400, end=-1, resolution=None, now=None, backend=None):
+        """
+        Returns the series of the given RRD file, see :func:`fetch_series`,
+        or of the given file of a storage backend.
+        """
+        fetch = backend and backend.fetch or fetch_series
+        if now is None:
+            now = time.time()
+        key, window = self._key(filepath, cf, start, end, resolution, now)
+        start, end = key[2], key[3]
+
+        previous = None
+        with self.lock:
+            series = self.entries.pop(key, None)
+            if series is not None:
+                self.entries[key] = series
+                self.hits += 1
+                return series
+            self.misses += 1
+            if window in self.windows:
+                previous = self.entries.get(self.windows[window])
+
+        series = None
+        if previous is not None:
+            series = refresh_series(filepath, cf, previous, start, end, fetch)
+        if series is None:
+            series = fetch(filepath, cf, start, end, resolution)
+        else:
+            with self.lock:
+                self.refreshes += 1
+        for array in series:
+            array.flags.writeable = False
+        self.add(key, series, window)
+        return series
+
+    def fetch_file(self, filepath, ds_name, cf='AVERAGE', start=-86400, end=-1, resolution=None, now=None,
+                   backend=None):
+        """
+        Returns a temporary RRD file holding the series of the given file,
+        see :meth:`fetch`, or None if the series is empty.
+
+        The file is only written when its series is first requested, and
+        must be handed back with :meth:`release` once graphed.
+        """
+        if now is None:
+            now = time.time()
+        key = self._key(filepath, cf, start, end, resolution, now)[0]
+        series = self.fetch(filepath, cf, start, end, resolution, now, backend)
+        if not len(series[0]):
+            return None
+        with self.lock:
+            if key in self.files and self.entries.get(key) is series:
+                path = self.files[key][0]
+                self.users[path] += 1
+                return path
+
+        handle, path = tempfile.mkstemp(suffix='.rrd')
+        os.close(handle)
+        try:
+            series_to_rrd(path, ds_name, *series)
+            size = os.path.getsize(path)
+        except:
+            os.remove(path)
+            raise
+        with self.lock:
+            self.users[path] = 1
+            if key in self.files or self.entries.get(key) is not series:
+                # another thread was faster, or the series is already gone
+                self.files[path] = None
+            else:
+                self.files[key] = (path, size)
+                self.size += size
+                self._evict()
+        return path
+
+    def release(self, path):
+        """
+        Hands back a file returned by :meth:`fetch_file`, removing it if it
+        is no longer cached.
+
+        Returns False if the file does not belong to the cache.
+        """
+        with self.lock:
+            if path not in self.users:
+                return False
+            self.users[path] -= 1
+            if self.users[path] or self.files.pop(path, False) is False:
+                return True
+            del self.users[path]
+        os.remove(path)
+        return True
+
+    def add(self, key, series, window=None):
+        """
+        Stores a series, evicting the least recently used ones as needed.
+        """
+        size = sum(array.nbytes for array in series)
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = series
+            self.size += size
+            if window is not None:
+                self.windows[window] = key
+                self.window_keys[key] = window
+            self._evict()
+
+    def clear(self):
+        """
+        Removes all the cached series.
+        """
+        with self.lock:
+            for key in list(self.entries):
+                self._remove(key)
+            self.size = 0
+
+    def _evict(self):
+        while self.size > self.max_bytes and self.entries:
+            self._remove(next(iter(self.entries)))
+
+    def _remove(self, key):
+        series = self.entries.pop(key)
+        self.size -= sum(array.nbytes for array in series)
+        window = self.window_keys.pop(key, None)
+        if self.windows.get(window) == key:
+            del self.windows[window]
+        if key in self.files:
+            path, size = self.files.pop(key)
+            self.size -= size
+            if self.users.get(path):
+                # removed by the last user
+                self.files[path] = None
+            else:
+                self.users.pop(path, None)
+                os.remove(path)
+
+
+def refresh_series(filepath, cf, series, start, end, fetch=fetch_rrd):
+    """
+    Moves a series fetched by :func:`fetch_rrd` to the time range between
+    the UNIX timestamps `start` and `end`, fetching only the rows it does
+    not hold yet with the given `fetch` function.
+
+    Returns the new (timestamps, values) tuple, or None if the series
+    cannot be moved, for instance because it includes archived data.
+    """
+    timestamps, values = series
+    if len(timestamps) < 3:
+        return None
+    step = int(timestamps[1] - timestamps[0])
+    if (numpy.diff(timestamps) != step).any():
+        return None
+
+    # the last rows may have been fetched before their step was complete
+    last = int(timestamps[-1])
+    tail_start = last - 2 * step
+    if tail_start <= start or end <= last - step:
+        return None
+    tail_timestamps, tail_values = fetch(filepath, cf, tail_start, end, step)
+    if (not len(tail_timestamps) or tail_timestamps[0] > last
+            or (len(tail_timestamps) > 1 and tail_timestamps[1] - tail_timestamps[0] != step)
+            or (tail_timestamps[0] - timestamps[0]) % step):
+        return None
+
+    mask = (timestamps > start // step * step) & (timestamps < tail_timestamps[0])
+    return (numpy.concatenate([timestamps[mask], tail_timestamps]),
+            numpy.concatenate([values[mask], tail_values]))
+
+
+series_cache = SeriesCache(getattr(settings, 'TIMEGRAPH_SERIES_CACHE_SIZE', 0))
+atexit.register(series_cache.clear)
@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+#
+# django-timegraph - monitoring graphs for django
+# Copyright (c) 2011-2012, Wifirst
+# Copyright (c) 2013, Jeremy Lainé
+# All rights reserved.
+#
+# See AUTHORS file for a full list of contributors.
+#
+# Redistribution and use in source and binary forms, with or without modification,
+# are permitted provided that the following conditions are met:
+#
+#     1. Redistributions of source code must retain the above copyright notice,
+#        this list of conditions and the following disclaimer.
+#
+#     2. Redistributions in binary form must reproduce the above copyright
+#        notice, this list of conditions and the following disclaimer in the
+#        documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR
+# ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+# ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+import os
+import struct
+import uuid
+import zlib
+
+import numpy
+from django.conf import settings
+from django.core.cache import cache
+
+from timegraph.models import Metric
+
+SPARKLINE_WIDTH = getattr(settings, 'TIMEGRAPH_SPARKLINE_WIDTH', 100)
+SPARKLINE_HEIGHT = getattr(settings, 'TIMEGRAPH_SPARKLINE_HEIGHT', 20)
+SPARKLINE_START = getattr(settings, 'TIMEGRAPH_SPARKLINE_START', -86400)
+SPARKLINE_COLOR = '#0066B3'
+
+# how long the sparklines of a page can be fetched after it was rendered
+SPRITE_TIMEOUT = 3600
+
+
+def _item_key(sprite_id, index):
+    return '%s/sprite/%s/%d' % (Metric.cache_prefix, sprite_id, index)
+
+
+class Sprite(object):
+    """
+    The sparklines requested while rendering a page, which are all drawn
+    in a single image, one below the other.
+
+    Each sparkline is cached under its own key, so that adding one does
+    not write the previous ones again.
+    """
+    def __init__(self):
+        self.id = uuid.uuid4().hex
+        self.items = []
+
+    def add(self, metric, obj):
+        """
+        Adds the sparkline of the given metric and object, and returns its
+        vertical offset in the image.
+        """
+        obj_type = obj.__class__.__name__.lower()
+        obj_pk = str(obj.pk).replace(':', '')
+        item = (metric.pk, obj_type, obj_pk)
+        cache.set(_item_key(self.id, len(self.items)), item, SPRITE_TIMEOUT)
+        self.items.append(item)
+        return (len(self.items) - 1) * SPARKLINE_HEIGHT
+
+
+def get_sprite_items(sprite_id, batch_size=100):
+    """
+    Returns the (metric pk, object type, object pk) of the sparklines of
+    the given sprite, or None if it is unknown or has expired.
+
+    The items are read `batch_size` at a time, up to the first missing one.
+    """
+    items = []
+    while True:
+        keys = [_item_key(sprite_id, i) for i in range(len(items), len(items) + batch_size)]
+        found = cache.get_many(keys)
+        for key in keys:
+            if key not in found:
+                return items or None
+            items.append(found[key])
+
+
+def render_sprite(items, width=SPARKLINE_WIDTH, height=SPARKLINE_HEIGHT, start=SPARKLINE_START):
+    """
+    Draws the sparklines of the given (metric pk, object type, object pk)
+    one below the other and returns the PNG image data.
+
+    Series are fetched at the coarsest resolution which still has a row
+    per pixel, see :meth:`timegraph.storage.StorageBackend.resolution`.
+    """
+    metrics = Metric.objects.in_bulk(set(item[0] for item in items))
+    colors = []
+    pixels = numpy.zeros((height * len(items), width), dtype=numpy.uint8)
+    for i, (metric_pk, obj_type, obj_pk) in enumerate(items):
+        metric = metrics.get(metric_pk)
+        if metric is None:
+            continue
+        filepath = metric._rrd_path_for(obj_type, obj_pk)
+        if not os.path.exists(filepath):
+            continue
+        backend = metric.backend
+        timestamps, values = backend.fetch(filepath, 'AVERAGE', start, -1, backend.resolution(-start, width))
+        color = metric.graph_color or SPARKLINE_COLOR
+        if color not in colors:
+            colors.append(color)
+        _draw(pixels[i * height:(i + 1) * height], values, colors.index(color) + 1)
+    return encode_png(pixels, colors)
+
+
+def _draw(cell, values, color):
+    """
+    Draws a line through the given values in a cell of the image.
+    """
+    height, width = cell.shape
+    if not len(values):
+        return
+    values = values[numpy.arange(width) * len(values) // width]
+    known = ~numpy.isnan(values)
+    if not known.any():
+        return
+    low, high = values[known].min(), values[known].max()
+    rows = numpy.empty(width, dtype=numpy.int64)
+    rows.fill(height // 2)
+    if high > low:
+        scale = (height - 1) / (high - low)
+        rows[known] = height - 1 - numpy.round((values[known] - low) * scale).astype(numpy.int64)
+
+    previous = None
+    for x in range(width):
+        if not known[x]:
+            previous = None
+            continue
+        y = rows[x]
+        # join the point to the previous one with a vertical segment
+        if previous is None:
+            top, bottom = y, y
+        else:
+            top, bottom = min(y, previous), max(y, previous)
+        cell[top:bottom + 1, x] = color
+        previous = y
+
+
+def _chunk(kind, data):
+    return (struct.pack('!I', len(data)) + kind + data +
+            struct.pack('!I', zlib.crc32(kind + data) & 0xffffffff))
+
+
+def encode_png(pixels, colors):
+    """
+    Encodes an array of palette indexes as a PNG image. Index 0 is
+    transparent, and index i is the i-th of the given '#RRGGBB' colors.
+    """
+    height, width = pixels.shape
+    palette = b'\0\0\0' + b''.join(
+        struct.pack('!BBB', int(color[1:3], 16), int(color[3:5], 16), int(color[5:7], 16))
+        for color in colors)
+    # each row starts with the filter type, 0 for none
+    rows = numpy.zeros((height, width + 1), dtype=numpy.uint8)
+    rows[:, 1:] = pixels
+    return b''.join([
+        b'\x89PNG\r\n\x1a\n',
+        _chunk(b'IHDR', struct.pack('!IIBBBBB', width, height, 8, 3, 0, 0, 0)),
+        _chunk(b'PLTE', palette),
+        _chunk(b'tRNS', b'\0'),
+        _chunk(b'IDAT', zlib.compress(rows.tobytes(), 9)),
+        _chunk(b'IEND', b''),
+    ])
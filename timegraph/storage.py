@@ -0,0 +1,352 @@
+# -*- coding: utf-8 -*-
+#
+# django-timegraph - monitoring graphs for django
+# Copyright (c) 2011-2012, Wifirst
+# Copyright (c) 2013, Jeremy Lainé
+# All rights reserved.
+#
+# See AUTHORS file for a full list of contributors.
+#
+# Redistribution and use in source and binary forms, with or without modification,
+# are permitted provided that the following conditions are met:
+#
+#     1. Redistributions of source code must retain the above copyright notice,
+#        this list of conditions and the following disclaimer.
+#
+#     2. Redistributions in binary form must reproduce the above copyright
+#        notice, this list of conditions and the following disclaimer in the
+#        documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR
+# ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+# ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+import errno
+import fcntl
+import mmap
+import os
+import struct
+import threading
+import time
+import uuid
+import warnings
+from collections import OrderedDict
+from importlib import import_module
+
+import numpy
+import rrdtool
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+from timegraph.locking import lock_file
+from timegraph.models import create_rrd, RRD_ARCHIVES, RRD_STEP
+from timegraph.series import fetch_series
+
+# dotted paths of the storage backends, by name
+STORAGE_BACKENDS = {
+    'rrd': 'timegraph.storage.RRDBackend',
+    'ring': 'timegraph.storage.RingBackend',
+}
+STORAGE_BACKENDS.update(getattr(settings, 'TIMEGRAPH_STORAGE_BACKENDS', {}))
+
+
+class StorageBackend(object):
+    """
+    Stores the series of metrics, one file per metric and object.
+
+    `extension` is the extension of the files, and `graphable` tells
+    whether rrdtool can graph them directly.
+    """
+    extension = None
+    graphable = False
+
+    def create(self, filepath, ds_name, start=None):
+        """
+        Creates the file of a series, whose first sample may be just after
+        the UNIX timestamp `start`. Returns False if it already exists.
+        """
+        raise NotImplementedError
+
+    def write_batch(self, filepath, samples):
+        """
+        Stores the given (timestamp, value) samples, in chronological order.
+        A timestamp of 'N' stands for the current time.
+
+        Returns False if the file no longer exists, for instance because it
+        was moved by a rebalance.
+        """
+        raise NotImplementedError
+
+    def fetch(self, filepath, cf='AVERAGE', start=-86400, end=-1, resolution=None):
+        """
+        Returns the (timestamps, values) of a series as numpy arrays, see
+        :func:`timegraph.series.fetch_rrd`.
+        """
+        raise NotImplementedError
+
+    def last(self, filepath):
+        """
+        Returns the UNIX timestamp of the last update of a series.
+        """
+        raise NotImplementedError
+
+    def resolution(self, span, width):
+        """
+        Returns the coarsest resolution at which a series over `span`
+        seconds still has a row for each of `width` pixels.
+        """
+        return max(span // width, 1)
+
+    def delete(self, filepath):
+        """
+        Deletes the file of a series.
+        """
+        os.remove(filepath)
+
+
+class RRDBackend(StorageBackend):
+    """
+    Stores series in RRD files, see :data:`timegraph.models.RRD_ARCHIVES`.
+    """
+    extension = '.rrd'
+    graphable = True
+
+    def create(self, filepath, ds_name, start=None):
+        return create_rrd(filepath, ds_name, start=start)
+
+    def write_batch(self, filepath, samples):
+        # serialize updates from concurrent processes
+        try:
+            with lock_file(filepath, create=False) as fd:
+                if not os.fstat(fd).st_nlink:
+                    return False
+                rrdtool.update(str(filepath), *[str("%s:%s" % sample) for sample in samples])
+                return True
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return False
+
+    def fetch(self, filepath, cf='AVERAGE', start=-86400, end=-1, resolution=None):
+        return fetch_series(filepath, cf, start, end, resolution)
+
+    def last(self, filepath):
+        return rrdtool.last(str(filepath))
+
+    def resolution(self, span, width):
+        archives = []
+        for rra in RRD_ARCHIVES:
+            cf, steps, rows = rra.split(':')[1], rra.split(':')[3], rra.split(':')[4]
+            if cf == 'AVERAGE':
+                archives.append((int(steps) * RRD_STEP, int(rows)))
+        # the coarsest archive covering the span with a row per pixel, or
+        # else the finest one covering it
+        covering = [step for step, rows in archives if step * rows >= span] or [max(archives)[0]]
+        fitting = [step for step in covering if span // step >= width]
+        return fitting and max(fitting) or min(covering)
+
+
+# header of ring files: magic, step, number of rows and last update
+RING_HEADER = struct.Struct('=8sqqq')
+RING_MAGIC = b'TGRING1\0'
+
+
+class RingBackend(StorageBackend):
+    """
+    Stores series in ring buffers of `rows` values, one every `step`
+    seconds, in memory-mapped files.
+
+    Files are kept open and mapped by each process, so that an update only
+    writes to memory, which suits metrics updated far more often than RRD
+    files can be. A row holds the last value written during its step, and
+    coarser resolutions are consolidated when fetching.
+    """
+    extension = '.ring'
+
+    def __init__(self, step=None, rows=None, max_open=256):
+        self.step = step or getattr(settings, 'TIMEGRAPH_RING_STEP', 10)
+        self.rows = rows or getattr(settings, 'TIMEGRAPH_RING_ROWS', 8640)
+        self.max_open = max_open
+        self.lock = threading.RLock()
+        self.pid = None
+        self.files = OrderedDict()
+
+    def create(self, filepath, ds_name, start=None):
+        if start is None:
+            start = int(time.time()) - 10
+        dirpath = os.path.dirname(filepath)
+        try:
+            os.makedirs(dirpath)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+        # as for RRD files, link a complete file into place
+        tmp_path = '%s.%s.tmp' % (filepath, uuid.uuid4().hex)
+        try:
+            values = numpy.empty(self.rows, dtype=numpy.float64)
+            values.fill(numpy.nan)
+            with open(tmp_path, 'wb') as fp:
+                fp.write(RING_HEADER.pack(RING_MAGIC, self.step, self.rows, int(start)))
+                fp.write(values.tobytes())
+            try:
+                os.link(tmp_path, filepath)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+                return False
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        return True
+
+    def write_batch(self, filepath, samples):
+        with self.lock:
+            try:
+                ring = self._open(filepath)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+                return False
+            fd, data, step, rows = ring[0], ring[2], ring[3], ring[4]
+
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                if not os.fstat(fd).st_nlink:
+                    self._close(filepath)
+                    return False
+                last = self._last(ring)
+                for timestamp, value in samples:
+                    timestamp = timestamp == 'N' and int(time.time()) or int(timestamp)
+                    # a second sample in the same second replaces the first one
+                    if timestamp < last:
+                        raise ValueError('illegal attempt to update using time %d when last update time is %d'
+                                         % (timestamp, last))
+                    # rows without updates in between hold unknown values
+                    skipped = numpy.arange(last // step + 1, timestamp // step)[-rows:]
+                    data[skipped % rows] = numpy.nan
+                    data[timestamp // step % rows] = value == 'U' and numpy.nan or float(value)
+                    last = timestamp
+                RING_HEADER.pack_into(ring[1], 0, RING_MAGIC, step, rows, last)
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+        return True
+
+    def fetch(self, filepath, cf='AVERAGE', start=-86400, end=-1, resolution=None):
+        ring = self._open(filepath)
+        data, step, rows = ring[2], ring[3], ring[4]
+        last = self._last(ring)
+
+        now = int(time.time())
+        start = int(start) < 0 and now + int(start) or int(start)
+        end = int(end) < 0 and now + int(end) or int(end)
+        resolution = max(step, (resolution or step) // step * step)
+        start -= start % resolution
+        end += resolution - end % resolution
+
+        # a row is timestamped with the end of the step it covers
+        timestamps = numpy.arange(start + step, end + step, step, dtype=numpy.int64)
+        last_end = last // step * step + step
+        valid = (timestamps > last_end - rows * step) & (timestamps <= last_end)
+        values = numpy.empty(len(timestamps), dtype=numpy.float64)
+        values.fill(numpy.nan)
+        values[valid] = data[(timestamps[valid] // step - 1) % rows]
+
+        if resolution == step:
+            return timestamps, values
+        count = resolution // step
+        values = values.reshape(len(values) // count, count)
+        with warnings.catch_warnings():
+            # consolidating steps which are all unknown
+            warnings.simplefilter('ignore', RuntimeWarning)
+            if cf == 'MAX':
+                values = numpy.nanmax(values, axis=1)
+            else:
+                values = numpy.nanmean(values, axis=1)
+        return timestamps[count - 1::count], values
+
+    def last(self, filepath):
+        return self._last(self._open(filepath))
+
+    def delete(self, filepath):
+        with self.lock:
+            self._close(filepath)
+        os.remove(filepath)
+
+    def _last(self, ring):
+        return RING_HEADER.unpack_from(ring[1], 0)[3]
+
+    def _open(self, filepath):
+        """
+        Returns the (fd, map, values, step, rows) of the given file, which
+        stays open until it is one of the least recently used ones.
+        """
+        with self.lock:
+            # files must not be shared with forked processes
+            if self.pid != os.getpid():
+                self.files = OrderedDict()
+                self.pid = os.getpid()
+
+            ring = self.files.pop(filepath, None)
+            if ring is None:
+                fd = os.open(filepath, os.O_RDWR)
+                try:
+                    buf = mmap.mmap(fd, 0)
+                except:
+                    os.close(fd)
+                    raise
+                magic, step, rows, last = RING_HEADER.unpack_from(buf, 0)
+                if magic != RING_MAGIC:
+                    buf.close()
+                    os.close(fd)
+                    raise ValueError('%s is not a ring file' % filepath)
+                data = numpy.frombuffer(buf, dtype=numpy.float64, count=rows, offset=RING_HEADER.size)
+                ring = (fd, buf, data, step, rows)
+                while len(self.files) >= self.max_open:
+                    self._close(next(iter(self.files)))
+            self.files[filepath] = ring
+            return ring
+
+    def _close(self, filepath):
+        """
+        Closes the given file if it is open. Must be called with the lock held.
+        """
+        ring = self.files.pop(filepath, None)
+        if ring is not None:
+            os.close(ring[0])
+
+
+_backends = {}
+
+
+def get_backend(name):
+    """
+    Returns the storage backend with the given name.
+    """
+    if name not in _backends:
+        if name not in STORAGE_BACKENDS:
+            raise ImproperlyConfigured('Unknown storage backend %r' % name)
+        module, attr = STORAGE_BACKENDS[name].rsplit('.', 1)
+        _backends[name] = getattr(import_module(module), attr)()
+    return _backends[name]
+
+
+def get_backend_for(filepath):
+    """
+    Returns the storage backend of the given file, from its extension, or
+    None if it is not the file of a series.
+    """
+    extension = os.path.splitext(filepath)[1]
+    for name in sorted(STORAGE_BACKENDS):
+        backend = get_backend(name)
+        if backend.extension == extension:
+            return backend
+    return None
@@ -29,10 +29,49 @@
 # SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 #
 
+from django.conf import settings
 from django.template import Library
+from django.utils.html import escape
+from django.utils.safestring import mark_safe
+
+try:
+    from django.urls import reverse
+except ImportError:
+    from django.core.urlresolvers import reverse
 
 from timegraph.models import format_value
+from timegraph.sparkline import Sprite, SPARKLINE_HEIGHT, SPARKLINE_WIDTH
+from timegraph.views import render_sparklines
 
 register = Library()
 
 register.filter('format_value', format_value)
+
+@register.simple_tag(takes_context=True)
+def timegraph_sparkline(context, metric, obj):
+    """
+    Renders the sparkline of the given metric for the given object.
+
+    All the sparklines of a page are drawn in a single image, served by the
+    render_sparklines view, of which each sparkline shows a slice.
+    """
+    sprite = get_sprite(context)
+    offset = sprite.add(metric, obj)
+    url = '%s?id=%s' % (getattr(settings, 'TIMEGRAPH_SPARKLINE_URL', None) or reverse(render_sparklines), sprite.id)
+    return mark_safe('<span class="timegraph-sparkline" style="display: inline-block; width: %dpx; height: %dpx; '
+                     'background: url(%s) 0 -%dpx no-repeat;"></span>' % (
+                     SPARKLINE_WIDTH, SPARKLINE_HEIGHT, escape(url), offset))
+
+def get_sprite(context):
+    """
+    Returns the sprite of the page being rendered, which is shared by the
+    templates rendered for the same request.
+    """
+    request = context.get('request')
+    if request is not None:
+        if not hasattr(request, '_timegraph_sprite'):
+            request._timegraph_sprite = Sprite()
+        return request._timegraph_sprite
+    if 'timegraph_sprite' not in context.render_context:
+        context.render_context['timegraph_sprite'] = Sprite()
+    return context.render_context['timegraph_sprite']
@@ -29,27 +29,77 @@
 # SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 #
 
+import gzip
+import io
+import json
+import multiprocessing
 import os
+import re
+import rrdtool
 import shutil
+import struct
+import sys
 import tempfile
+import threading
+import time
+import zlib
+
+import numpy
 
 from django.conf import settings
 from django.contrib.auth.models import User
+from django.contrib.sessions.models import Session
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured, ValidationError
+from django.http import Http404
+from django.template import Context, Template
 from django.test import TestCase
+from django.test.client import RequestFactory
+from django.utils import timezone
 
 import timegraph
-from timegraph.models import format_value, Graph, Metric
+from timegraph.admission import admission_controller, AdmissionController, estimate_cost, Overloaded
+from timegraph.export import export_series
+from timegraph.forms import GraphForm
+from timegraph.ingest import iter_lines
+from timegraph.archive import archive_month
+from timegraph.models import create_rrd, format_value, Graph, Metric, RRD_ARCHIVES, RRD_STEP
+from timegraph.placement import HashRing
+from timegraph.provision import provision
+from timegraph.query import reduce_series
+from timegraph.rebalance import rebalance
+from timegraph.reaper import Reaper
+from timegraph.rrdfile import RRDFile
+from timegraph.series import archive_boundary, fetch_rrd, fetch_series, read_archive, series_cache, SeriesCache
+from timegraph.sparkline import get_sprite_items, Sprite
+from timegraph.storage import get_backend
+from timegraph.views import ingest_polling, render_graph, render_metric, render_sparklines, render_top
 
 def setup_test_environment():
     timegraph.original_rrd_root = settings.TIMEGRAPH_RRD_ROOT
     settings.TIMEGRAPH_RRD_ROOT = tempfile.mkdtemp()
+    Metric.rrd_root = settings.TIMEGRAPH_RRD_ROOT
 
 def teardown_test_environment():
     shutil.rmtree(settings.TIMEGRAPH_RRD_ROOT)
 
     settings.TIMEGRAPH_RRD_ROOT = timegraph.original_rrd_root
+    Metric.rrd_root = settings.TIMEGRAPH_RRD_ROOT
     del timegraph.original_rrd_root
 
+def fill_rrd(metric, obj, values, step=RRD_STEP):
+    """
+    Creates the RRD file of the given metric and object, with one value
+    per step up to the current time.
+    """
+    filepath = metric.rrd_path(obj)
+    now = int(time.time()) // step * step
+    start = now - len(values) * step
+    create_rrd(filepath, metric.pk, start=start)
+    rrdtool.update(filepath, *[str('%d:%s' % (start + (i + 1) * step, value))
+                               for i, value in enumerate(values)])
+    return filepath
+
 class TestFormat(TestCase):
     def test_format_none(self):
         self.assertEquals(format_value(None, 'b'), '')
@@ -262,3 +312,1025 @@ class TestMetric(TestCase):
     def test_unicode(self):
         m = Metric(name='foo bar')
         self.assertEquals(unicode(m), 'foo bar')
+
+def create_user_rrd(filepath):
+    return create_rrd(filepath, 1)
+
+class TestCreate(TestCase):
+    def setUp(self):
+        setup_test_environment()
+        self.filepath = os.path.join(settings.TIMEGRAPH_RRD_ROOT, 'user', '1', '1.rrd')
+
+    def tearDown(self):
+        teardown_test_environment()
+
+    def test_create(self):
+        self.assertTrue(create_rrd(self.filepath, 1))
+        self.assertFalse(create_rrd(self.filepath, 1))
+        self.assertEquals(os.listdir(os.path.dirname(self.filepath)), ['1.rrd'])
+
+    def test_create_concurrently(self):
+        pool = multiprocessing.Pool(4)
+        try:
+            results = pool.map(create_user_rrd, [self.filepath] * 16)
+        finally:
+            pool.close()
+            pool.join()
+        self.assertEquals(results.count(True), 1)
+        self.assertEquals(os.listdir(os.path.dirname(self.filepath)), ['1.rrd'])
+
+class TestExport(TestCase):
+    fixtures = ['test_timegraph_metrics.json', 'test_timegraph_users.json']
+
+    def setUp(self):
+        setup_test_environment()
+
+    def tearDown(self):
+        teardown_test_environment()
+
+    def test_export(self):
+        metric = Metric.objects.get(pk=1)
+        user = User.objects.get(pk=1)
+        other = User.objects.create(username='test_user_2')
+        empty = User.objects.create(username='test_user_3')
+        values = [1.0, 2.0, 'U', 4.0, 5.0, 6.0]
+        fill_rrd(metric, user, values)
+        now = int(time.time()) // RRD_STEP * RRD_STEP
+        written = dict((now - (len(values) - 1 - i) * RRD_STEP, value)
+                       for i, value in enumerate(values) if value != 'U')
+
+        # a file with a coarser grid, as created under another step
+        step = 2 * RRD_STEP
+        other_path = metric.rrd_path(other)
+        other_now = int(time.time()) // step * step
+        if not os.path.exists(os.path.dirname(other_path)):
+            os.makedirs(os.path.dirname(other_path))
+        rrdtool.create(str(other_path), '--start', str(other_now - 3 * step), '--step', str(step),
+                       'DS:1:GAUGE:%d:U:U' % (2 * step), *RRD_ARCHIVES)
+        rrdtool.update(str(other_path), *[str('%d:%s' % (other_now - (2 - i) * step, value))
+                                          for i, value in enumerate([10.0, 20.0, 30.0])])
+        other_written = dict((other_now - (2 - i) * step, value)
+                             for i, value in enumerate([10.0, 20.0, 30.0]))
+
+        fileobj = io.BytesIO()
+        count = export_series(fileobj, [metric], [user, other, empty], start=now - 3600, end=now,
+                              chunk_size=1, processes=1)
+        self.assertEquals(count, 3)
+
+        fileobj.seek(0)
+        data = numpy.load(fileobj)
+        grid = list(data['timestamps'])
+        self.assertEquals(list(data['metrics']), [1])
+        self.assertEquals(list(data['pks_00000']), [u'1'])
+        self.assertEquals(list(data['pks_00001']), [unicode(other.pk)])
+        self.assertEquals(data['values_00000'].shape, (1, 1, len(grid)))
+        self.assertTrue(set(written) <= set(grid))
+
+        # the values of the first file, on its own grid
+        for timestamp, value in zip(grid, data['values_00000'][0, 0]):
+            if timestamp in written:
+                self.assertEquals(value, written[timestamp])
+            else:
+                self.assertTrue(numpy.isnan(value))
+
+        # the values of the coarser file, aligned on the rows covering each point
+        for timestamp, value in zip(grid, data['values_00001'][0, 0]):
+            covering = -(-timestamp // step) * step
+            if covering in other_written:
+                self.assertEquals(value, other_written[covering])
+            else:
+                self.assertTrue(numpy.isnan(value))
+        self.assertEquals(sorted(set(data['values_00001'][0, 0][~numpy.isnan(data['values_00001'][0, 0])])),
+                          [10.0, 20.0, 30.0])
+
+        self.assertTrue(numpy.isnan(data['values_00002']).all())
+
+    def test_export_empty(self):
+        metric = Metric.objects.get(pk=1)
+        user = User.objects.get(pk=1)
+
+        fileobj = io.BytesIO()
+        count = export_series(fileobj, [metric], [user], processes=1)
+        self.assertEquals(count, 1)
+
+        fileobj.seek(0)
+        data = numpy.load(fileobj)
+        self.assertEquals(len(data['timestamps']), 0)
+        self.assertEquals(data['values_00000'].shape, (1, 1, 0))
+
+class TestReaper(TestCase):
+    fixtures = ['test_timegraph_metrics.json', 'test_timegraph_users.json']
+
+    def setUp(self):
+        setup_test_environment()
+
+    def tearDown(self):
+        teardown_test_environment()
+
+    def test_reap_orphans(self):
+        metric = Metric.objects.get(pk=1)
+        user = User.objects.get(pk=1)
+        other = User.objects.create(username='test_user_2')
+        metric.set_polling(user, '1.23')
+        metric.set_polling(other, '4.56')
+        other_key = metric._cache_key(other)
+        other_path = metric.rrd_path(other)
+        other.delete()
+
+        stats = Reaper(workers=1).run()
+        self.assertEquals(stats['objects'], 1)
+        self.assertEquals(stats['files'], 0)
+        self.assertTrue(os.path.exists(metric.rrd_path(user)))
+        self.assertFalse(os.path.exists(os.path.dirname(other_path)))
+        self.assertEquals(cache.get(other_key), None)
+
+    def test_reap_colons(self):
+        metric = Metric.objects.get(pk=1)
+        live = Session.objects.create(session_key='host:a', session_data='', expire_date=timezone.now())
+        other = Session.objects.create(session_key='host:b', session_data='', expire_date=timezone.now())
+        metric.set_polling(live, '1.23')
+        metric.set_polling(other, '4.56')
+        other_path = metric.rrd_path(other)
+        other.delete()
+
+        # keys whose colons were stripped from the path are still found
+        stats = Reaper(workers=1).run()
+        self.assertEquals(stats['objects'], 1)
+        self.assertTrue(os.path.exists(metric.rrd_path(live)))
+        self.assertFalse(os.path.exists(os.path.dirname(other_path)))
+
+    def test_reap_stale(self):
+        metric = Metric.objects.get(pk=1)
+        user = User.objects.get(pk=1)
+        metric.set_polling(user, '1.23')
+        filepath = metric.rrd_path(user)
+
+        stats = Reaper(days=1, workers=1).run()
+        self.assertEquals(stats['files'], 0)
+        self.assertTrue(os.path.exists(filepath))
+
+        # no update for three days
+        os.remove(filepath)
+        create_rrd(filepath, metric.pk, start=int(time.time()) - 3 * 86400)
+        archive_root = tempfile.mkdtemp()
+        try:
+            stats = Reaper(days=1, archive_root=archive_root, workers=1).run()
+            self.assertEquals(stats['files'], 1)
+            self.assertFalse(os.path.exists(filepath))
+            self.assertTrue(os.path.exists(os.path.join(archive_root, 'user', '1', '1.rrd')))
+        finally:
+            shutil.rmtree(archive_root)
+
+    def test_resume(self):
+        metric = Metric.objects.get(pk=1)
+        user = User.objects.get(pk=1)
+        metric.set_polling(user, '1.23')
+        os.utime(metric.rrd_path(user), (0, 0))
+
+        cursor_path = os.path.join(settings.TIMEGRAPH_RRD_ROOT, 'cursor')
+        with open(cursor_path, 'w') as fp:
+            fp.write('user/1\n')
+        stats = Reaper(days=1, cursor_path=cursor_path, workers=1).run()
+        self.assertEquals(stats['files'], 0)
+        self.assertTrue(os.path.exists(metric.rrd_path(user)))
+        self.assertFalse(os.path.exists(cursor_path))
+
+class TestQuery(TestCase):
+    fixtures = ['test_timegraph_metrics.json', 'test_timegraph_users.json']
+
+    def setUp(self):
+        setup_test_environment()
+        self.metric = Metric.objects.get(pk=1)
+        for i in range(2, 4):
+            User.objects.create(username='test_user_%d' % i)
+        for user in User.objects.all():
+            fill_rrd(self.metric, user, [user.pk] * 12)
+
+    def tearDown(self):
+        teardown_test_environment()
+
+    def test_reduce_series(self):
+        values = numpy.array([1.0, numpy.nan, 3.0, 2.0])
+        self.assertEquals(reduce_series(values, 'avg'), 2.0)
+        self.assertEquals(reduce_series(values, 'max'), 3.0)
+        self.assertEquals(reduce_series(values, 'min'), 1.0)
+        self.assertEquals(reduce_series(values, 'last'), 2.0)
+        self.assertEquals(reduce_series(values, 'percentile', 50), 2.0)
+        self.assertEquals(reduce_series(numpy.array([numpy.nan]), 'avg'), None)
+        self.assertRaises(ValueError, reduce_series, values, 'foo')
+
+    def test_top(self):
+        users = User.objects.order_by('pk')
+        top = self.metric.top(users, count=2, processes=1)
+        self.assertEquals([(obj.pk, value) for obj, value in top], [(3, 3.0), (2, 2.0)])
+
+        top = self.metric.top(users, count=1, bottom=True, reduction='max', processes=1)
+        self.assertEquals([(obj.pk, value) for obj, value in top], [(1, 1.0)])
+
+        top = self.metric.top(users, count=2, threads=2)
+        self.assertEquals([(obj.pk, value) for obj, value in top], [(3, 3.0), (2, 2.0)])
+        self.assertEquals(self.metric.top(users, count=0), [])
+
+    def test_render_top(self):
+        request = RequestFactory().get('/', {'count': 1})
+        response = render_top(request, self.metric, User.objects.order_by('pk'))
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals(response['Content-Type'], 'application/json')
+        self.assertEquals(json.loads(response.content), [{'pk': '3', 'name': 'test_user_3', 'value': 3.0}])
+
+        request = RequestFactory().get('/', {'count': 0})
+        response = render_top(request, self.metric, User.objects.order_by('pk'))
+        self.assertEquals(response.status_code, 400)
+
+class TestProfiling(TestCase):
+    fixtures = ['test_timegraph_metrics.json', 'test_timegraph_users.json']
+
+    def setUp(self):
+        setup_test_environment()
+        self.metric = Metric.objects.get(pk=1)
+        self.user = User.objects.get(pk=1)
+        self.graph = Graph.objects.create(slug='thoughts', title='Thoughts')
+        self.graph.metrics.add(self.metric)
+        fill_rrd(self.metric, self.user, [1.0] * 12)
+
+    def tearDown(self):
+        teardown_test_environment()
+
+    def get(self, params, is_staff=True):
+        request = RequestFactory().get('/', params)
+        request.user = User(is_staff=is_staff)
+        return render_graph(request, self.graph, self.user)
+
+    def test_disabled(self):
+        response = self.get({})
+        self.assertEquals(response['Content-Type'], 'image/png')
+        self.assertFalse(response.has_header('X-Timegraph-Profile'))
+
+        response = self.get({'profile': '1'}, is_staff=False)
+        self.assertFalse(response.has_header('X-Timegraph-Profile'))
+
+    def test_headers(self):
+        response = self.get({'profile': '1'})
+        self.assertEquals(response['Content-Type'], 'image/png')
+        phases = [x.split('=')[0] for x in response['X-Timegraph-Profile'].split(', ')]
+        self.assertEquals(phases, ['form', 'sql', 'cache', 'stat', 'series', 'rrdtool', 'total'])
+
+    def test_json(self):
+        response = self.get({'profile': 'cprofile'})
+        self.assertEquals(response['Content-Type'], 'application/json')
+        result = json.loads(response.content)
+        self.assertEquals(result['status'], 200)
+        self.assertEquals([x['name'] for x in result['phases']], ['form', 'sql', 'cache', 'stat', 'series', 'rrdtool'])
+        self.assertTrue('profile' in result)
+
+    def test_exception(self):
+        request = RequestFactory().get('/', {'profile': 'cprofile'})
+        request.user = User(is_staff=True)
+        with self.assertRaises(Http404):
+            render_graph(request, self.graph, User.objects.create(username='unprofiled_user'))
+        # profiling stops with the view
+        self.assertEquals(sys.getprofile(), None)
+
+class TestImageFormat(TestCase):
+    fixtures = ['test_timegraph_metrics.json', 'test_timegraph_users.json']
+
+    def setUp(self):
+        setup_test_environment()
+        self.metric = Metric.objects.get(pk=1)
+        self.user = User.objects.get(pk=1)
+        self.graph = Graph.objects.create(slug='thoughts', title='Thoughts')
+        self.graph.metrics.add(self.metric)
+        fill_rrd(self.metric, self.user, [1.0] * 12)
+
+    def tearDown(self):
+        teardown_test_environment()
+
+    def test_options(self):
+        form = GraphForm({})
+        self.assertTrue(form.is_valid())
+        options = form.options()
+        self.assertEquals(options[:2], ['--imgformat', 'PNG'])
+        self.assertFalse('--zoom' in options)
+        self.assertEquals(form.content_type(), 'image/png')
+
+        form = GraphForm({'format': 'svg', 'zoom': '2', 'mono': '1'})
+        self.assertTrue(form.is_valid())
+        options = form.options()
+        self.assertEquals(options[:2], ['--imgformat', 'SVG'])
+        self.assertEquals(options[options.index('--zoom') + 1], 2.0)
+        self.assertTrue('--graph-render-mode' in options)
+        self.assertEquals(form.content_type(), 'image/svg+xml')
+
+        self.assertFalse(GraphForm({'format': 'gif'}).is_valid())
+        self.assertFalse(GraphForm({'zoom': '10'}).is_valid())
+
+    def test_svgz(self):
+        request = RequestFactory().get('/', {'format': 'svgz'}, HTTP_ACCEPT_ENCODING='gzip, deflate')
+        response = render_graph(request, self.graph, self.user)
+        self.assertEquals(response['Content-Type'], 'image/svg+xml')
+        self.assertEquals(response['Content-Encoding'], 'gzip')
+        self.assertEquals(response['Vary'], 'Accept-Encoding')
+        image_data = gzip.GzipFile(fileobj=io.BytesIO(response.content)).read()
+        self.assertTrue(len(image_data) > 0)
+
+    def test_svgz_plain(self):
+        request = RequestFactory().get('/', {'format': 'svgz'})
+        response = render_graph(request, self.graph, self.user)
+        self.assertEquals(response['Content-Type'], 'image/svg+xml')
+        self.assertFalse(response.has_header('Content-Encoding'))
+        self.assertEquals(response['Vary'], 'Accept-Encoding')
+        self.assertTrue(len(response.content) > 0)
+
+class TestPlacement(TestCase):
+    fixtures = ['test_timegraph_metrics.json', 'test_timegraph_users.json']
+
+    def setUp(self):
+        setup_test_environment()
+        self.roots = [os.path.join(settings.TIMEGRAPH_RRD_ROOT, name) for name in ['a', 'b']]
+
+    def tearDown(self):
+        Metric.rrd_rebalancing = False
+        teardown_test_environment()
+
+    def test_ring(self):
+        keys = ['user/%d' % i for i in range(1000)]
+        ring = HashRing(['a', 'b', 'c', 'd'])
+        before = dict((key, ring.get_node(key)) for key in keys)
+        self.assertEquals(set(before.values()), set(['a', 'b', 'c', 'd']))
+
+        ring = HashRing(['a', 'b', 'c', 'd', 'e'])
+        moved = [key for key in keys if ring.get_node(key) != before[key]]
+        self.assertTrue(0 < len(moved) < 350)
+        self.assertEquals(set(ring.get_node(key) for key in moved), set(['e']))
+
+    def test_rebalance(self):
+        metric = Metric.objects.get(pk=1)
+        users = [User.objects.create(username='placed_user_%d' % i) for i in range(10)]
+        Metric.rrd_root = self.roots[:1]
+        for user in users:
+            metric.set_polling(user, '1.23')
+
+        Metric.rrd_root = self.roots
+        Metric.rrd_rebalancing = True
+        moving = [user for user in users if metric.rrd_path(user) != os.path.join(Metric.rrd_dir('user', str(user.pk)), '1.rrd')]
+        self.assertTrue(moving)
+
+        # other roots are only looked up during a rebalance
+        Metric.rrd_rebalancing = False
+        self.assertFalse(metric.rrd_path(moving[0]).startswith(self.roots[0]))
+        Metric.rrd_rebalancing = True
+        for user in moving:
+            self.assertTrue(metric.rrd_path(user).startswith(self.roots[0]))
+
+        # the file of the first object was also created on its new root
+        history = rrdtool.last(metric.rrd_path(moving[0]))
+        conflict_dir = Metric.rrd_dir('user', str(moving[0].pk))
+        create_rrd(os.path.join(conflict_dir, '1.rrd'), metric.pk, start=history + RRD_STEP)
+
+        objects, files, conflicts = rebalance()
+        self.assertEquals(objects, len(moving))
+        self.assertEquals(files, len(moving))
+        self.assertEquals(conflicts, 1)
+        # the moved file is kept, the other one is set aside
+        self.assertEquals(rrdtool.last(os.path.join(conflict_dir, '1.rrd')), history)
+        aside = [name for name in os.listdir(conflict_dir) if name.endswith('.conflict')]
+        self.assertEquals(len(aside), 1)
+        self.assertEquals(rrdtool.last(os.path.join(conflict_dir, aside[0])), history + RRD_STEP)
+        for user in users:
+            self.assertEquals(metric.rrd_path(user), os.path.join(Metric.rrd_dir('user', str(user.pk)), '1.rrd'))
+            self.assertTrue(os.path.exists(metric.rrd_path(user)))
+        for user in moving:
+            self.assertFalse(os.path.exists(os.path.join(self.roots[0], 'user', str(user.pk))))
+            metric.update_rrd(user, [(int(time.time()) + RRD_STEP, '4.56')])
+
+        self.assertEquals(rebalance(), (0, 0, 0))
+
+class TestAdmission(TestCase):
+    fixtures = ['test_timegraph_metrics.json', 'test_timegraph_users.json']
+
+    def setUp(self):
+        setup_test_environment()
+        self.directory = tempfile.mkdtemp()
+        self.threads = []
+
+    def tearDown(self):
+        for thread, release in self.threads:
+            release.set()
+            thread.join()
+        shutil.rmtree(self.directory)
+        teardown_test_environment()
+
+    def hold(self, controller, client, cost):
+        """
+        Runs a request in a thread, returning events to wait for it to be
+        admitted and to release it.
+        """
+        admitted = threading.Event()
+        release = threading.Event()
+
+        def run():
+            with controller.admit(client, cost):
+                admitted.set()
+                release.wait()
+        thread = threading.Thread(target=run)
+        thread.start()
+        self.threads.append((thread, release))
+        return admitted, release
+
+    def test_estimate_cost(self):
+        self.assertTrue(estimate_cost(1, -86400, -1, 300, 200) < 2)
+        self.assertTrue(estimate_cost(1000, -86400, -1, 300, 200) > 1000)
+        self.assertTrue(estimate_cost(1, -86400 * 365, -1, 300, 200) > estimate_cost(1, -86400, -1, 300, 200))
+        self.assertTrue(estimate_cost(1, -86400, -1, 3000, 2000) > estimate_cost(1, -86400, -1, 300, 200))
+
+    def test_admit(self):
+        controller = AdmissionController(max_running=1, max_queued=1, per_client=1, timeout=5,
+                                         directory=self.directory)
+        admitted, release = self.hold(controller, 'a', 100)
+        self.assertTrue(admitted.wait(5))
+
+        # cheap requests are not limited
+        with controller.admit('a', 1):
+            pass
+        # per-client limit
+        with self.assertRaises(Overloaded):
+            with controller.admit('a', 100):
+                pass
+
+        queued, queued_release = self.hold(controller, 'b', 100)
+        while not controller.state()[1]:
+            time.sleep(0.01)
+        # full queue
+        with self.assertRaises(Overloaded):
+            with controller.admit('c', 100):
+                pass
+
+        release.set()
+        self.assertTrue(queued.wait(5))
+        queued_release.set()
+
+    def test_priority(self):
+        controller = AdmissionController(max_running=1, timeout=5, directory=self.directory)
+        admitted, release = self.hold(controller, 'a', 100)
+        self.assertTrue(admitted.wait(5))
+
+        order = []
+        lock = threading.Lock()
+
+        def run(client, cost):
+            with controller.admit(client, cost):
+                with lock:
+                    order.append(cost)
+        threads = [threading.Thread(target=run, args=('b', 500)),
+                   threading.Thread(target=run, args=('c', 50))]
+        for i, thread in enumerate(threads):
+            thread.start()
+            while len(controller.state()[1]) <= i:
+                time.sleep(0.01)
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEquals(order, [50, 500])
+
+    def test_timeout(self):
+        controller = AdmissionController(max_running=1, timeout=0.1, directory=self.directory)
+        admitted, release = self.hold(controller, 'a', 100)
+        self.assertTrue(admitted.wait(5))
+        with self.assertRaises(Overloaded):
+            with controller.admit('b', 100):
+                pass
+        self.assertEquals(controller.state(), (['a'], []))
+
+    def test_processes(self):
+        controller = AdmissionController(max_running=1, max_queued=1, per_client=1, timeout=0.1,
+                                         directory=self.directory)
+
+        def run(admitted, release):
+            with controller.admit('a', 100):
+                admitted.set()
+                release.wait(5)
+
+        admitted = multiprocessing.Event()
+        release = multiprocessing.Event()
+        process = multiprocessing.Process(target=run, args=(admitted, release))
+        process.start()
+        try:
+            self.assertTrue(admitted.wait(5))
+            # slots and per-client limits are shared with other processes
+            self.assertEquals(controller.state(), (['a'], []))
+            with self.assertRaises(Overloaded):
+                with controller.admit('a', 100):
+                    pass
+            with self.assertRaises(Overloaded):
+                with controller.admit('b', 100):
+                    pass
+            self.assertEquals(controller.state(), (['a'], []))
+        finally:
+            release.set()
+            process.join()
+        with controller.admit('b', 100):
+            pass
+
+        # the slot of a process which dies is freed
+        admitted = multiprocessing.Event()
+        process = multiprocessing.Process(target=run, args=(admitted, multiprocessing.Event()))
+        process.start()
+        self.assertTrue(admitted.wait(5))
+        process.terminate()
+        process.join()
+        self.assertEquals(controller.state(), ([], []))
+        with controller.admit('b', 100):
+            pass
+
+    def test_render(self):
+        metric = Metric.objects.get(pk=1)
+        user = User.objects.get(pk=1)
+        fill_rrd(metric, user, [1.0] * 12)
+        admission_controller.max_running = 1
+        admission_controller.max_queued = 0
+        admission_controller.cheap_cost = 0
+        directory = admission_controller.directory
+        admission_controller.directory = self.directory
+        try:
+            admitted, release = self.hold(admission_controller, 'other', 100)
+            self.assertTrue(admitted.wait(5))
+            response = render_metric(RequestFactory().get('/'), metric, User.objects.all())
+            self.assertEquals(response.status_code, 503)
+            self.assertEquals(response['Retry-After'], str(admission_controller.timeout))
+
+            release.set()
+            while admission_controller.state()[0]:
+                time.sleep(0.01)
+            response = render_metric(RequestFactory().get('/'), metric, User.objects.all())
+            self.assertEquals(response.status_code, 200)
+
+            # any iterable of objects is accepted, and only read once
+            users = (user for user in User.objects.all())
+            response = render_metric(RequestFactory().get('/'), metric, users)
+            self.assertEquals(response.status_code, 200)
+        finally:
+            admission_controller.max_running = 0
+            admission_controller.max_queued = 32
+            admission_controller.cheap_cost = 20
+            admission_controller.directory = directory
+
+class TestRRDFile(TestCase):
+    fixtures = ['test_timegraph_metrics.json', 'test_timegraph_users.json']
+
+    def setUp(self):
+        setup_test_environment()
+        self.metric = Metric.objects.get(pk=1)
+        self.user = User.objects.get(pk=1)
+        self.filepath = fill_rrd(self.metric, self.user, [float(i % 7) for i in range(800)])
+
+    def tearDown(self):
+        teardown_test_environment()
+
+    def assertSeriesEqual(self, series, expected):
+        self.assertTrue(numpy.array_equal(series[0], expected[0]))
+        self.assertTrue(numpy.allclose(series[1], expected[1], equal_nan=True))
+
+    def test_header(self):
+        with RRDFile(self.filepath) as rrd:
+            self.assertEquals(rrd.step, RRD_STEP)
+            self.assertEquals(rrd.ds_names, ['1'])
+            self.assertEquals([(archive.cf, archive.pdp_cnt, archive.row_cnt) for archive in rrd.archives[:2]],
+                              [('AVERAGE', 1, 600), ('AVERAGE', 6, 600)])
+            self.assertEquals(rrd.last_update(), rrdtool.last(self.filepath))
+
+    def test_fetch(self):
+        with RRDFile(self.filepath) as rrd:
+            for cf, start, resolution in [('AVERAGE', -3600, None), ('MAX', -86400, None),
+                                          ('AVERAGE', -86400 * 3, 1800), ('MAX', -86400 * 30, 86400)]:
+                self.assertSeriesEqual(rrd.fetch(cf, start, -1, resolution),
+                                       fetch_rrd(self.filepath, cf, start, -1, resolution))
+
+    def test_segments(self):
+        with RRDFile(self.filepath) as rrd:
+            archive = rrd.archives[0]
+            older, newer = archive.segments()
+            self.assertEquals(len(older) + len(newer), archive.row_cnt)
+            self.assertFalse(older.flags.writeable)
+            self.assertFalse(older.flags.owndata)
+
+            timestamps, values = archive.series()
+            start = int(timestamps[-10])
+            self.assertSeriesEqual((timestamps[-10:], values[-10:]),
+                                   fetch_rrd(self.filepath, 'AVERAGE', start - RRD_STEP, start + 9 * RRD_STEP - 1))
+
+    def test_invalid(self):
+        filepath = os.path.join(settings.TIMEGRAPH_RRD_ROOT, 'invalid.rrd')
+        with open(filepath, 'wb') as fp:
+            fp.write(b'\0' * 1024)
+        with self.assertRaises(ValueError):
+            RRDFile(filepath)
+
+class TestStorage(TestCase):
+    fixtures = ['test_timegraph_metrics.json', 'test_timegraph_users.json']
+
+    def setUp(self):
+        setup_test_environment()
+        self.metric = Metric.objects.get(pk=1)
+        self.metric.storage = 'ring'
+        self.metric.save()
+        self.user = User.objects.get(pk=1)
+        self.backend = get_backend('ring')
+
+    def tearDown(self):
+        teardown_test_environment()
+
+    def test_default(self):
+        self.assertEquals(Metric(pk=2).backend, get_backend('rrd'))
+        self.assertTrue(Metric(pk=2).rrd_path(self.user).endswith('2.rrd'))
+        self.assertEquals(self.metric.backend, self.backend)
+        self.assertTrue(self.metric.rrd_path(self.user).endswith('1.ring'))
+
+    def test_resolution(self):
+        backend = get_backend('rrd')
+        self.assertEquals(backend.resolution(86400, 100), 300)
+        self.assertEquals(backend.resolution(7 * 86400, 100), 1800)
+        self.assertEquals(backend.resolution(365 * 86400, 100), 86400)
+        self.assertEquals(backend.resolution(3600, 100), 300)
+        self.assertEquals(backend.resolution(1000 * 86400, 100), 86400)
+        self.assertEquals(self.backend.resolution(86400, 100), 864)
+
+    def test_write_fetch(self):
+        step = self.backend.step
+        now = int(time.time()) // 60 * 60
+        samples = [(now - 60 + i * step, float(i)) for i in range(6)]
+        self.metric.update_rrd(self.user, samples)
+        filepath = self.metric.rrd_path(self.user)
+        self.assertEquals(self.backend.last(filepath), samples[-1][0])
+
+        timestamps, values = self.backend.fetch(filepath, 'AVERAGE', now - 60, now - 1)
+        self.assertEquals(list(timestamps), list(range(now - 60 + step, now + step, step)))
+        self.assertEquals(list(values), [0.0, 1.0, 2.0, 3.0, 4.0, 5.0])
+
+        timestamps, values = self.backend.fetch(filepath, 'AVERAGE', now - 60, now - 1, 60)
+        self.assertEquals((list(timestamps), list(values)), ([now], [2.5]))
+        timestamps, values = self.backend.fetch(filepath, 'MAX', now - 60, now - 1, 60)
+        self.assertEquals((list(timestamps), list(values)), ([now], [5.0]))
+
+        # older samples are refused, and skipped steps are unknown
+        with self.assertRaises(ValueError):
+            self.metric.update_rrd(self.user, [(now - 60, 1.0)])
+        self.metric.update_rrd(self.user, [(now + 3 * step, 'U'), (now + 5 * step, 7.0)])
+        timestamps, values = self.backend.fetch(filepath, 'AVERAGE', now, now + 6 * step - 1)
+        self.assertTrue(numpy.isnan(values[:5]).all())
+        self.assertEquals(values[5], 7.0)
+
+    def test_same_second(self):
+        now = int(time.time())
+        self.metric.update_rrd(self.user, [(now, 1.0), (now, 2.0)])
+        self.metric.set_polling(self.user, '3.0')
+        self.metric.set_polling(self.user, '4.0')
+        filepath = self.metric.rrd_path(self.user)
+        last = self.backend.last(filepath)
+        timestamps, values = self.backend.fetch(filepath, 'AVERAGE', last - 1, last)
+        self.assertEquals(values[-1], 4.0)
+
+    def test_wrap(self):
+        backend = type(self.backend)(step=10, rows=4)
+        filepath = os.path.join(settings.TIMEGRAPH_RRD_ROOT, 'wrap.ring')
+        backend.create(filepath, '1', start=995)
+        backend.write_batch(filepath, [(1000 + i * 10, float(i)) for i in range(6)])
+        timestamps, values = backend.fetch(filepath, 'AVERAGE', 1000, 1059)
+        self.assertEquals(list(timestamps), [1010, 1020, 1030, 1040, 1050, 1060])
+        self.assertTrue(numpy.isnan(values[:2]).all())
+        self.assertEquals(list(values[2:]), [2.0, 3.0, 4.0, 5.0])
+
+        backend.delete(filepath)
+        self.assertFalse(os.path.exists(filepath))
+        self.assertFalse(backend.write_batch(filepath, [(1100, 1.0)]))
+
+    def test_validate(self):
+        self.metric.storage = 'rnig'
+        with self.assertRaises(ValidationError):
+            self.metric.clean()
+        with self.assertRaises(ImproperlyConfigured):
+            self.metric.backend
+        self.metric.storage = ''
+        self.metric.clean()
+
+    def test_reap(self):
+        other = User.objects.create(username='ring_user')
+        self.metric.set_polling(other, '1.23')
+        filepath = self.metric.rrd_path(other)
+        self.assertTrue(filepath in self.backend.files)
+        other.delete()
+
+        # the reaper deletes the file through the backend, which closes it
+        self.assertEquals(Reaper(workers=1).run()['objects'], 1)
+        self.assertFalse(os.path.exists(filepath))
+        self.assertFalse(filepath in self.backend.files)
+
+    def test_render(self):
+        graph = Graph.objects.create(slug='thoughts', title='Thoughts')
+        graph.metrics.add(self.metric)
+        self.metric.set_polling(self.user, '1.23')
+        response = render_graph(RequestFactory().get('/'), graph, self.user)
+        self.assertEquals(response.status_code, 200)
+
+class TestSparkline(TestCase):
+    fixtures = ['test_timegraph_metrics.json', 'test_timegraph_users.json']
+
+    def setUp(self):
+        setup_test_environment()
+        settings.TIMEGRAPH_SPARKLINE_URL = '/sparklines/'
+        self.metric = Metric.objects.get(pk=1)
+        self.users = [User.objects.get(pk=1), User.objects.create(username='sparkline_user')]
+        fill_rrd(self.metric, self.users[0], [float(i % 5) for i in range(288)])
+
+    def tearDown(self):
+        del settings.TIMEGRAPH_SPARKLINE_URL
+        teardown_test_environment()
+
+    def test_sprite(self):
+        template = Template('{% load timegraph_tags %}'
+                            '{% for user in users %}{% timegraph_sparkline metric user %}{% endfor %}')
+        html = template.render(Context({'metric': self.metric, 'users': self.users}))
+        urls = re.findall(r'url\((/sparklines/\?id=\w+)\) 0 -(\d+)px', html)
+        self.assertEquals(len(urls), 2)
+        self.assertEquals(urls[0][0], urls[1][0])
+        self.assertEquals([int(offset) for url, offset in urls], [0, 20])
+
+        response = render_sparklines(RequestFactory().get(urls[0][0]))
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals(response['Content-Type'], 'image/png')
+        self.assertEquals(response.content[:8], b'\x89PNG\r\n\x1a\n')
+        width, height = struct.unpack('!II', response.content[16:24])
+        self.assertEquals((width, height), (100, 40))
+
+        # the first sparkline is drawn, the second object has no data
+        idat = response.content.index(b'IDAT')
+        length = struct.unpack('!I', response.content[idat - 4:idat])[0]
+        rows = numpy.frombuffer(zlib.decompress(response.content[idat + 4:idat + 4 + length]), dtype=numpy.uint8)
+        pixels = rows.reshape(height, width + 1)[:, 1:]
+        self.assertTrue(pixels[:20].any())
+        self.assertFalse(pixels[20:].any())
+
+    def test_items(self):
+        sprite = Sprite()
+        for i in range(250):
+            self.assertEquals(sprite.add(self.metric, self.users[i % 2]), i * 20)
+        items = get_sprite_items(sprite.id)
+        self.assertEquals(len(items), 250)
+        self.assertEquals(items[:2], [(1, 'user', '1'), (1, 'user', str(self.users[1].pk))])
+
+    def test_unknown(self):
+        with self.assertRaises(Http404):
+            render_sparklines(RequestFactory().get('/sparklines/', {'id': 'unknown'}))
+
+class TestProvision(TestCase):
+    fixtures = ['test_timegraph_metrics.json', 'test_timegraph_users.json']
+
+    def setUp(self):
+        setup_test_environment()
+
+    def tearDown(self):
+        teardown_test_environment()
+
+    def test_provision(self):
+        metric = Metric.objects.get(pk=1)
+        User.objects.create(username='test_user_2')
+        users = User.objects.order_by('pk')
+
+        calls = []
+        def progress(objects, created, obj):
+            calls.append((objects, created, obj.pk))
+
+        self.assertEquals(provision([metric], users, chunk_size=1, processes=1, progress=progress), (2, 2))
+        self.assertEquals(calls, [(1, 1, 1), (2, 2, 2)])
+        for user in users:
+            self.assertTrue(os.path.exists(metric.rrd_path(user)))
+
+        self.assertEquals(provision([metric], users, processes=1), (2, 0))
+
+class TestIngest(TestCase):
+    fixtures = ['test_timegraph_metrics.json', 'test_timegraph_users.json']
+
+    def setUp(self):
+        setup_test_environment()
+
+    def tearDown(self):
+        teardown_test_environment()
+
+    def post(self, lines, **extra):
+        payload = '\n'.join(lines).encode('utf-8')
+        if extra.get('HTTP_CONTENT_ENCODING') == 'gzip':
+            buf = io.BytesIO()
+            fp = gzip.GzipFile(fileobj=buf, mode='wb')
+            fp.write(payload)
+            fp.close()
+            payload = buf.getvalue()
+        request = RequestFactory().post('/', payload, content_type='application/x-ndjson', **extra)
+        response = ingest_polling(request, User.objects.all())
+        self.assertEquals(response.status_code, 200)
+        return json.loads(response.content)
+
+    def test_ingest(self):
+        metric = Metric.objects.get(pk=1)
+        user = User.objects.get(pk=1)
+        now = int(time.time())
+        result = self.post([
+            json.dumps({'pk': 1, 'time': now - 600, 'values': {'thoughts': 1.5}}),
+            json.dumps({'pk': '1', 'time': now - 300, 'values': {'thoughts': 2.5}}),
+            '',
+            json.dumps({'pk': 2, 'values': {'thoughts': 1}}),
+            json.dumps({'pk': 1, 'values': {'foo': 1}}),
+            'garbage',
+        ])
+        self.assertEquals(result['samples'], 2)
+        self.assertEquals([error['line'] for error in result['errors']], [4, 5, 6])
+        self.assertEquals(metric.get_polling(user), 2.5)
+        self.assertTrue(os.path.exists(metric.rrd_path(user)))
+
+        # values which could not be stored are not cached either
+        result = self.post([json.dumps({'pk': 1, 'time': now - 900, 'values': {'thoughts': 0.5}})])
+        self.assertEquals(result['samples'], 0)
+        self.assertEquals(len(result['errors']), 1)
+        self.assertEquals(metric.get_polling(user), 2.5)
+
+    def test_ingest_gzip(self):
+        metric = Metric.objects.get(pk=1)
+        user = User.objects.get(pk=1)
+        result = self.post([json.dumps({'pk': 1, 'values': {'thoughts': '3.5'}})], HTTP_CONTENT_ENCODING='gzip')
+        self.assertEquals(result, {'samples': 1, 'errors': []})
+        self.assertEquals(metric.get_polling(user), 3.5)
+
+    def test_ingest_long_line(self):
+        now = int(time.time())
+        result = self.post([
+            json.dumps({'pk': 1, 'time': now - 600, 'values': {'thoughts': 1.5}}),
+            json.dumps({'pk': 1, 'time': now - 450, 'values': {'thoughts': 'x' * 70000}}),
+            json.dumps({'pk': 1, 'time': now - 300, 'values': {'thoughts': 2.5}}),
+        ])
+        self.assertEquals(result, {'samples': 2, 'errors': [{'line': 2, 'error': 'line too long'}]})
+
+    def test_iter_lines_gzip(self):
+        # a small body which decompresses to 32MB
+        buf = io.BytesIO()
+        fp = gzip.GzipFile(fileobj=buf, mode='wb')
+        for i in range(512):
+            fp.write(b' ' * 65536)
+        fp.write(b'\n{}\n')
+        fp.close()
+        self.assertTrue(len(buf.getvalue()) < 100000)
+        buf.seek(0)
+
+        lines = iter_lines(buf, 'gzip', chunk_size=4096, max_line=1024)
+        self.assertEquals(list(lines), [None, b'{}', b''])
+
+    def test_ingest_get(self):
+        response = ingest_polling(RequestFactory().get('/'), User.objects.all())
+        self.assertEquals(response.status_code, 405)
+
+class TestArchive(TestCase):
+    fixtures = ['test_timegraph_metrics.json', 'test_timegraph_users.json']
+
+    def setUp(self):
+        setup_test_environment()
+        self.original_archive_root = Metric.archive_root
+        Metric.archive_root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(Metric.archive_root)
+        Metric.archive_root = self.original_archive_root
+        teardown_test_environment()
+
+    def test_archive(self):
+        metric = Metric.objects.get(pk=1)
+        user = User.objects.get(pk=1)
+        filepath = fill_rrd(metric, user, [2.0] * 48)
+
+        now = int(time.time())
+        months = set([time.gmtime(now - 4 * 3600)[:2], time.gmtime(now)[:2]])
+        count = sum(archive_month(year, month) for year, month in months)
+        self.assertTrue(count >= 1)
+        segments = os.listdir(os.path.join(Metric.archive_root, 'user'))
+        self.assertEquals(len(segments), count)
+
+        # nothing new to archive, no new segment
+        self.assertEquals(sum(archive_month(year, month) for year, month in months), 0)
+        self.assertEquals(sorted(os.listdir(os.path.join(Metric.archive_root, 'user'))), sorted(segments))
+
+        # a broken segment does not hide the others
+        for year, month in months:
+            with open(os.path.join(Metric.archive_root, 'user', '%04d-%02d.0.broken.npz' % (year, month)), 'wb') as fp:
+                fp.write(b'PK garbage')
+
+        for cf in ['AVERAGE', 'MAX']:
+            timestamps, values = read_archive(filepath, cf, now - 4 * 3600, now)
+            values = values[~numpy.isnan(values)]
+            self.assertTrue(len(values) > 0)
+            self.assertTrue((values == 2.0).all())
+
+    def test_archive_boundary(self):
+        metric = Metric.objects.get(pk=1)
+        user = User.objects.get(pk=1)
+        filepath = fill_rrd(metric, user, [2.0] * 12)
+
+        self.assertEquals(archive_boundary(filepath, -86400), None)
+        self.assertNotEquals(archive_boundary(filepath, -700 * 86400), None)
+
+class TestSeriesCache(TestCase):
+    fixtures = ['test_timegraph_metrics.json', 'test_timegraph_users.json']
+
+    def setUp(self):
+        setup_test_environment()
+        self.metric = Metric.objects.get(pk=1)
+        self.user = User.objects.get(pk=1)
+        self.filepath = fill_rrd(self.metric, self.user, [1.0] * 12)
+
+    def tearDown(self):
+        teardown_test_environment()
+
+    def test_fetch(self):
+        cache = SeriesCache(1024 * 1024)
+        series = cache.fetch(self.filepath, start=-3600)
+        self.assertTrue(cache.fetch(self.filepath, start=-3600) is series)
+        self.assertEquals((cache.hits, cache.misses), (1, 1))
+        self.assertFalse(series[1].flags.writeable)
+
+        cache.fetch(self.filepath, cf='MAX', start=-3600)
+        self.assertEquals((cache.hits, cache.misses), (1, 2))
+        self.assertEquals(len(cache.entries), 2)
+
+    def test_evict(self):
+        cache = SeriesCache(1024 * 1024)
+        size = sum(array.nbytes for array in cache.fetch(self.filepath, start=-3600))
+        cache = SeriesCache(size)
+        cache.fetch(self.filepath, start=-3600)
+        cache.fetch(self.filepath, cf='MAX', start=-3600)
+        self.assertEquals(len(cache.entries), 1)
+        self.assertEquals(cache.size, size)
+
+        cache = SeriesCache(size - 1)
+        cache.fetch(self.filepath, start=-3600)
+        self.assertEquals(len(cache.entries), 0)
+
+    def test_fetch_file(self):
+        cache = SeriesCache(1024 * 1024)
+        path = cache.fetch_file(self.filepath, self.metric.pk, start=-3600)
+        self.assertTrue(cache.release(path))
+        self.assertEquals(cache.fetch_file(self.filepath, self.metric.pk, start=-3600), path)
+        self.assertEquals(cache.size, sum(array.nbytes for array in cache.entries.values()[0]) +
+                          os.path.getsize(path))
+        self.assertFalse(cache.release(self.filepath))
+
+        # files in use are only removed once released
+        cache.clear()
+        self.assertTrue(os.path.exists(path))
+        self.assertTrue(cache.release(path))
+        self.assertFalse(os.path.exists(path))
+        self.assertEquals(cache.users, {})
+
+    def test_evict_file(self):
+        cache = SeriesCache(1024 * 1024)
+        path = cache.fetch_file(self.filepath, self.metric.pk, start=-3600)
+        cache.release(path)
+        cache.max_bytes = cache.size - 1
+        cache.fetch(self.filepath, cf='MAX', start=-3600)
+        self.assertEquals(len(cache.entries), 1)
+        self.assertFalse(os.path.exists(path))
+
+    def test_refresh(self):
+        cache = SeriesCache(1024 * 1024)
+        now = time.time()
+        cache.fetch(self.filepath, start=-3600, now=now)
+        updated = int(now) // RRD_STEP * RRD_STEP + RRD_STEP
+        rrdtool.update(self.filepath, '%d:2.0' % updated)
+
+        now += RRD_STEP
+        timestamps, values = cache.fetch(self.filepath, start=-3600, now=now)
+        self.assertEquals((cache.misses, cache.refreshes), (2, 1))
+        start = int(now - 3600) // RRD_STEP * RRD_STEP
+        end = int(now - 1) // RRD_STEP * RRD_STEP
+        expected_timestamps, expected_values = fetch_series(self.filepath, start=start, end=end)
+        self.assertTrue(numpy.array_equal(timestamps, expected_timestamps))
+        self.assertTrue(numpy.allclose(values, expected_values, equal_nan=True))
+        self.assertEquals(values[list(timestamps).index(updated)], 2.0)
+
+        # absolute ranges are always fetched in full
+        cache.fetch(self.filepath, start=start + RRD_STEP, end=end + RRD_STEP)
+        self.assertEquals(cache.refreshes, 1)
+
+    def test_render(self):
+        graph = Graph.objects.create(slug='thoughts', title='Thoughts')
+        graph.metrics.add(self.metric)
+        series_cache.max_bytes = 1024 * 1024
+        hits = series_cache.hits
+        try:
+            paths = []
+            for i in range(2):
+                response = render_graph(RequestFactory().get('/'), graph, self.user)
+                self.assertEquals(response.status_code, 200)
+                paths.append(list(series_cache.files.values()))
+            self.assertEquals(series_cache.hits, hits + 1)
+            # the file written for the first request is graphed again
+            self.assertEquals(len(paths[0]), 1)
+            self.assertEquals(paths[0], paths[1])
+            self.assertTrue(os.path.exists(paths[1][0][0]))
+        finally:
+            series_cache.max_bytes = 0
+            series_cache.clear()
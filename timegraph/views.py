@@ -29,15 +29,30 @@
 # SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 #
 
+import json
 import os
+import re
 import rrdtool
 import tempfile
+import zlib
 
-from django.http import HttpResponse, HttpResponseBadRequest, Http404
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseBadRequest, HttpResponseNotAllowed, Http404
+from django.utils.cache import patch_vary_headers
 from django.utils.encoding import force_unicode
 
-from timegraph.forms import GraphForm
+from timegraph.admission import admission_control
+from timegraph.forms import GraphForm, TopForm
+from timegraph.ingest import ingest
 from timegraph.models import format_value
+from timegraph.profiling import get_profiler
+from timegraph.series import archive_boundary, resolve_time, series_cache, series_to_rrd
+from timegraph.sparkline import get_sprite_items, render_sprite
+
+re_accepts_gzip = re.compile(r'\bgzip\b')
+
+# threads reading the files of the objects ranked by render_top
+TOP_THREADS = getattr(settings, 'TIMEGRAPH_TOP_THREADS', 4)
 
 # colors from munin
 COLORS = [
@@ -47,96 +62,274 @@ COLORS = [
     '#666600', '#FFBFFF', '#00FFCC', '#CC6699', '#999900',
 ]
 
+def graph_file(data_file, metric, form, temp_files):
+    """
+    Returns the RRD file to graph for the given data file of a metric.
+
+    If the series cache is enabled, if the time range begins before the
+    data the file holds, or if rrdtool cannot read the files of the metric's
+    storage backend, this is a temporary file written from the series,
+    which is added to `temp_files`. The series cache keeps its files
+    between requests.
+    """
+    data = form.cleaned_data
+    backend = metric.backend
+    if backend.graphable:
+        resolution = None
+    else:
+        # no need for more rows than pixels
+        resolution = backend.resolution(resolve_time(data['end']) - resolve_time(data['start']), data['width'])
+    if series_cache.max_bytes:
+        path = series_cache.fetch_file(data_file, metric.pk, 'AVERAGE', data['start'], data['end'],
+                                       resolution, backend=backend)
+        if path is None:
+            return data_file
+        temp_files.append(path)
+        return path
+    elif not backend.graphable or archive_boundary(data_file, data['start']) is not None:
+        timestamps, values = backend.fetch(data_file, 'AVERAGE', data['start'], data['end'], resolution)
+    else:
+        return data_file
+    if not len(timestamps):
+        return data_file
+
+    handle, path = tempfile.mkstemp(suffix='.rrd')
+    os.close(handle)
+    try:
+        series_to_rrd(path, metric.pk, timestamps, values)
+    except:
+        os.remove(path)
+        raise
+    temp_files.append(path)
+    return path
+
+def image_response(request, form, image_data):
+    """
+    Returns an HTTP response holding the given image, in the format
+    requested by the form.
+
+    Compressed SVG is only sent to clients accepting gzip, the others
+    get plain SVG.
+    """
+    response = HttpResponse(content_type=form.content_type())
+    if form.cleaned_data['format'] == 'svgz':
+        if re_accepts_gzip.search(request.META.get('HTTP_ACCEPT_ENCODING', '')):
+            compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            image_data = compressor.compress(image_data) + compressor.flush()
+            response['Content-Encoding'] = 'gzip'
+        patch_vary_headers(response, ['Accept-Encoding'])
+    response.content = image_data
+    return response
+
+def ingest_polling(request, queryset):
+    """
+    Stores a batch of metric values for objects of the given queryset.
+
+    The request body holds one JSON object per line and may be compressed
+    with 'Content-Encoding: gzip', see :func:`timegraph.ingest.ingest`.
+    """
+    if request.method != 'POST':
+        return HttpResponseNotAllowed(['POST'])
+
+    result = ingest(request, queryset, encoding=request.META.get('HTTP_CONTENT_ENCODING'))
+    return HttpResponse(json.dumps(result), content_type='application/json')
+
+def graph_defs(graph, obj):
+    """
+    Returns the number of DEFs of the given graph, and the view's arguments.
+    """
+    return graph.metrics.count(), (graph, obj)
+
+def metric_defs(metric, object_list):
+    """
+    Returns the number of DEFs of the total of the given metric, and the
+    view's arguments, where the objects are evaluated once into a list.
+    """
+    object_list = list(object_list)
+    return len(object_list), (metric, object_list)
+
+@admission_control(graph_defs)
 def render_graph(request, graph, obj):
     """
     Renders the specified graph.
     """
-    # validate input
-    form = GraphForm(request.GET)
-    if not form.is_valid():
-        return HttpResponseBadRequest()
+    profiler = get_profiler(request)
+    with profiler:
+        # validate input
+        with profiler.phase('form'):
+            form = GraphForm(request.GET)
+            is_valid = form.is_valid()
+        if not is_valid:
+            return profiler.finish(HttpResponseBadRequest())
 
-    count = 0
-    options = []
-    if graph.is_stacked:
-        stack = ':STACK'
-    else:
-        stack = ''
-    is_memory = False
-    for metric in graph.metrics.order_by('graph_order'):
-        if metric.unit in ['b', 'B']:
-            is_memory = True
-        data_file = metric.rrd_path(obj)
-        value = metric.get_polling(obj)
-        if os.path.exists(data_file):
-            color = metric.graph_color
-            if not color:
-                color = COLORS[count % len(COLORS)]
-
-            # current value
-            value_str = format_value(value, metric.unit)
-            if value_str:
-                value_str = ' | ' + value_str
-
-            options += [
-                'DEF:%s=%s:%s:AVERAGE' % (count, data_file, metric.pk),
-                '%s:%s%s:%s%s%s' % (graph.type, count, color, metric.name, value_str, stack)]
-            count += 1
+        count = 0
+        options = []
+        if graph.is_stacked:
+            stack = ':STACK'
+        else:
+            stack = ''
+        is_memory = False
+        temp_files = []
+        with profiler.phase('sql'):
+            metrics = list(graph.metrics.order_by('graph_order'))
+        for metric in metrics:
+            if metric.unit in ['b', 'B']:
+                is_memory = True
+            data_file = metric.rrd_path(obj)
+            with profiler.phase('cache'):
+                value = metric.get_polling(obj)
+            with profiler.phase('stat'):
+                exists = os.path.exists(data_file)
+            if exists:
+                with profiler.phase('series'):
+                    data_file = graph_file(data_file, metric, form, temp_files)
+                color = metric.graph_color
+                if not color:
+                    color = COLORS[count % len(COLORS)]
 
-    # if no RRDs were found stop here
-    if not count:
-        raise Http404
+                # current value
+                value_str = format_value(value, metric.unit)
+                if value_str:
+                    value_str = ' | ' + value_str
 
-    if is_memory:
-        options += ['--base', '1024']
-    if graph.lower_limit is not None:
-        options += [ '--lower-limit', str(graph.lower_limit) ]
-        options += [ '-r' ]
-    if graph.upper_limit is not None:
-        options += [ '--upper-limit', str(graph.upper_limit) ]
-    options += form.options()
-    image_data = timegraph_rrd(options)
+                options += [
+                    'DEF:%s=%s:%s:AVERAGE' % (count, data_file, metric.pk),
+                    '%s:%s%s:%s%s%s' % (graph.type, count, color, metric.name, value_str, stack)]
+                count += 1
 
-    return HttpResponse(image_data, content_type='image/png')
+        # if no RRDs were found stop here
+        if not count:
+            raise Http404
 
+        if is_memory:
+            options += ['--base', '1024']
+        if graph.lower_limit is not None:
+            options += [ '--lower-limit', str(graph.lower_limit) ]
+            options += [ '-r' ]
+        if graph.upper_limit is not None:
+            options += [ '--upper-limit', str(graph.upper_limit) ]
+        options += form.options()
+        with profiler.phase('rrdtool'):
+            image_data = timegraph_rrd(options, temp_files)
+
+        return profiler.finish(image_response(request, form, image_data))
+
+@admission_control(metric_defs)
 def render_metric(request, metric, object_list):
     """
     Renders the total for the given metric.
     """
+    profiler = get_profiler(request)
+    with profiler:
+        # validate input
+        with profiler.phase('form'):
+            form = GraphForm(request.GET)
+            is_valid = form.is_valid()
+        if not is_valid:
+            return profiler.finish(HttpResponseBadRequest())
+
+        color = metric.graph_color
+        if not color:
+            color = '#990033'
+
+        count = 0
+        options = []
+        type = 'AREA'
+        temp_files = []
+        with profiler.phase('sql'):
+            object_list = list(object_list)
+        for obj in object_list:
+            data_file = metric.rrd_path(obj)
+            with profiler.phase('stat'):
+                exists = os.path.exists(data_file)
+            if exists:
+                with profiler.phase('series'):
+                    data_file = graph_file(data_file, metric, form, temp_files)
+                options += [
+                    'DEF:%s=%s:%s:AVERAGE' % (count, data_file, metric.pk),
+                    '%s:%s%s' % (type, count, color)]
+                type = 'STACK'
+                count += 1
+
+        # if no RRDs were found stop here
+        if not count:
+            raise Http404
+
+        options += form.options()
+        with profiler.phase('rrdtool'):
+            image_data = timegraph_rrd(options, temp_files)
+
+        return profiler.finish(image_response(request, form, image_data))
+
+def render_top(request, metric, object_list):
+    """
+    Renders the objects with the highest value of the given metric, either
+    as a JSON list or as a stacked graph.
+    """
     # validate input
-    form = GraphForm(request.GET)
+    form = TopForm(request.GET)
     if not form.is_valid():
         return HttpResponseBadRequest()
 
-    color = metric.graph_color
-    if not color:
-        color = '#990033'
+    data = form.cleaned_data
+    top = metric.top(object_list,
+        start=data['start'],
+        end=data['end'],
+        reduction=data['reduction'],
+        percentile=data['percentile'],
+        count=data['count'],
+        bottom=data['bottom'],
+        threads=TOP_THREADS)
 
-    count = 0
-    options = []
-    type = 'AREA'
-    for obj in object_list:
-        data_file = metric.rrd_path(obj)
-        if os.path.exists(data_file):
-            options += [
-                'DEF:%s=%s:%s:AVERAGE' % (count, data_file, metric.pk),
-                '%s:%s%s' % (type, count, color)]
-            type = 'STACK'
-            count += 1
+    if not data['graph']:
+        result = [{
+            'pk': force_unicode(obj.pk),
+            'name': force_unicode(obj),
+            'value': value,
+        } for obj, value in top]
+        return HttpResponse(json.dumps(result), content_type='application/json')
 
     # if no RRDs were found stop here
-    if not count:
+    if not top:
         raise Http404
 
+    options = []
+    temp_files = []
+    for count, (obj, value) in enumerate(top):
+        label = force_unicode(obj).replace(':', '\\:')
+        data_file = graph_file(metric.rrd_path(obj), metric, form, temp_files)
+        options += [
+            'DEF:%s=%s:%s:AVERAGE' % (count, data_file, metric.pk),
+            '%s:%s%s:%s | %s' % (count and 'STACK' or 'AREA', count, COLORS[count % len(COLORS)],
+                                 label, format_value(value, metric.unit))]
+
     options += form.options()
-    image_data = timegraph_rrd(options)
+    image_data = timegraph_rrd(options, temp_files)
+
+    return image_response(request, form, image_data)
 
-    return HttpResponse(image_data, content_type='image/png')
+def render_sparklines(request):
+    """
+    Renders all the sparklines of a page in a single image, see the
+    timegraph_sparkline template tag.
+    """
+    items = get_sprite_items(request.GET.get('id', ''))
+    if not items:
+        raise Http404
+    return HttpResponse(render_sprite(items), content_type='image/png')
 
-def timegraph_rrd(options):
+def timegraph_rrd(options, temp_files=()):
     """
     Invokes rrd_graph with the given options and returns the image data.
+
+    The given temporary files are removed afterwards, or handed back to
+    the series cache.
     """
-    image_file = tempfile.NamedTemporaryFile()
-    rrdtool.graph([str(image_file.name)] + [ force_unicode(x).encode('utf-8') for x in options ])
-    return image_file.read()
+    try:
+        image_file = tempfile.NamedTemporaryFile()
+        rrdtool.graph([str(image_file.name)] + [ force_unicode(x).encode('utf-8') for x in options ])
+        return image_file.read()
+    finally:
+        for path in temp_files:
+            if not series_cache.release(path):
+                os.remove(path)